@@ -35,27 +35,138 @@ def get_pixel(image, x, y):
     return image['pixels'][row*image['width']+col]
 
 
+# image stored in one contiguous bytearray instead of a list of ints (or tuples)
+# greyscale images use one byte per pixel
+# color images are stored planar: all red values, then all green, then all blue
+# indexing with 'height', 'width' or 'pixels' behaves like the dictionary form,
+# so every function that reads image['pixels'] also accepts a CompactImage
+class CompactImage:
+    def __init__(self, height, width, data=None, channels=1):
+        size = height * width * channels
+        if data is None:
+            data = bytearray(size)
+        if len(data) != size:
+            raise ValueError('Expected %d bytes of pixel data, got %d' % (size, len(data)))
+        self.height = height
+        self.width = width
+        self.channels = channels
+        self.data = data
+
+    # build from the dictionary form (pixels are ints or (r, g, b) tuples)
+    @classmethod
+    def from_dict(cls, image):
+        if isinstance(image, CompactImage):
+            return image
+        pixels = image['pixels']
+        if pixels and isinstance(pixels[0], tuple):
+            n = len(pixels)
+            data = bytearray(3 * n)
+            for c in range(3):
+                data[c * n:(c + 1) * n] = bytes(p[c] for p in pixels)
+            return cls(image['height'], image['width'], data, 3)
+        return cls(image['height'], image['width'], bytearray(pixels))
+
+    # export to the dictionary form
+    def to_dict(self):
+        if self.channels == 1:
+            pixels = list(self.data)
+        else:
+            pixels = list(zip(*self.planes()))
+        return {'height': self.height, 'width': self.width, 'pixels': pixels}
+
+    # zero-copy view of one channel
+    def plane(self, c):
+        n = self.height * self.width
+        return memoryview(self.data)[c * n:(c + 1) * n]
+
+    def planes(self):
+        return [self.plane(c) for c in range(self.channels)]
+
+    # greyscale CompactImage sharing the buffer of one channel
+    def channel_image(self, c):
+        return CompactImage(self.height, self.width, self.plane(c))
+
+    def copy(self):
+        return CompactImage(self.height, self.width, bytearray(self.data), self.channels)
+
+    def keys(self):
+        return ('height', 'width', 'pixels')
+
+    def __getitem__(self, key):
+        if key == 'height':
+            return self.height
+        if key == 'width':
+            return self.width
+        if key == 'pixels':
+            if self.channels == 1:
+                return self.data
+            return self.to_dict()['pixels']
+        raise KeyError(key)
+
+    def __len__(self):
+        return self.height * self.width
+
+    def __repr__(self):
+        return 'CompactImage(height=%d, width=%d, channels=%d)' % (self.height, self.width, self.channels)
+
+
+# returns a new image of the same kind as image (dictionary or CompactImage)
+# pixels must be integers in [0, 255] if image is a CompactImage
+def image_like(image, pixels):
+    if isinstance(image, CompactImage):
+        if not isinstance(pixels, bytearray):
+            pixels = bytearray(pixels)
+        return CompactImage(image['height'], image['width'], pixels)
+    if not isinstance(pixels, list):
+        pixels = list(pixels)
+    return {'height': image['height'], 'width': image['width'], 'pixels': pixels}
+
+
 def set_pixel(image, x, y, c):
     print(image['pixels'][x*image['width']+y])
     image['pixels'][x*image['width']+y] = c
 
 
+# images with at least this many pixels are mapped through a lookup table
+LUT_MIN_PIXELS = 1024
+
+
+# the 256 values func gives for the pixel values of an 8-bit image, as bytes
+# if they are all in [0, 255] themselves (None if func fails on some of them)
+def point_table(func):
+    try:
+        table = [func(v) for v in range(256)]
+    except Exception:
+        return None
+    try:
+        return bytes(table)
+    except (TypeError, ValueError):
+        return table
+
+
+# pixels are visited in row-major order, the same order as the pixels list
+# an 8-bit image only has 256 different values, so for big images func is
+# called once per value and the pixels are mapped through the table instead
 def apply_per_pixel(image, func):
-    result = {
-        'height': image['height'],
-        'width': image['width'],
-        'pixels': [],
-    }
-    for x in range(image['height']):
-        for y in range(image['width']):
-            color = get_pixel(image, x, y)
-            newcolor = func(color)
-            result['pixels'].append(newcolor)
-    return result
+    pixels = image['pixels']
+    if len(pixels) >= LUT_MIN_PIXELS:
+        try:
+            data = pixels if isinstance(pixels, (bytes, bytearray)) else bytes(pixels)
+        except (TypeError, ValueError):
+            data = None
+        table = point_table(func) if data is not None else None
+        if isinstance(table, bytes):
+            return image_like(image, data.translate(table))
+        if table is not None:
+            return image_like(image, [table[v] for v in data])
+    return image_like(image, [func(color) for color in pixels])
 
 
 def inverted(image):
-    return apply_per_pixel(image, lambda c: 255-c)
+    return apply_per_pixel(image, inverted.point)
+
+# the function applied to each pixel, for filters that only map pixel values
+inverted.point = lambda c: 255-c
 
 
 # HELPER FUNCTIONS
@@ -64,7 +175,7 @@ def inverted(image):
 # multiply subarray with kernel to produce a scalar output
 # update pixel to scalar output
 # return new list of pixels
-def correlate(image, kernel):
+def correlate(image, kernel, backend=None):
     """
     Compute the result of correlating the given image with the given kernel.
 
@@ -77,12 +188,23 @@ def correlate(image, kernel):
     separate structure to represent the output.
 
     Kernel represented by 2D array
-    """
-    updated_pixels = []
 
-    for x in range(image['height']):
-        for y in range(image['width']):
-            updated_pixels.append(multiply_array(get_subarray(image, x, y, kernel),kernel))
+    backend names one of CORRELATION_BACKENDS; by default the backend chosen
+    with set_correlation_backend is used
+    """
+    if backend is None:
+        backend = correlation_backend
+    if backend not in CORRELATION_BACKENDS:
+        raise ValueError('Unknown correlation backend: %r' % backend)
+
+    # kernels without a center pixel keep the original element-by-element path
+    if len(kernel) % 2 == 0 or len(kernel[0]) % 2 == 0:
+        updated_pixels = []
+        for x in range(image['height']):
+            for y in range(image['width']):
+                updated_pixels.append(multiply_array(get_subarray(image, x, y, kernel),kernel))
+    else:
+        updated_pixels = CORRELATION_BACKENDS[backend](image, kernel)
 
     im = {  'height': image['height'],
             'width': image['width'],
@@ -90,6 +212,56 @@ def correlate(image, kernel):
 
     return im
 
+
+# returns every row of the image padded by rw columns on each side,
+# repeating the edge pixels the same way get_pixel does
+def padded_rows(image, rw):
+    height = image['height']
+    width = image['width']
+    pixels = image['pixels']
+    rows = []
+    for i in range(height):
+        row = list(pixels[i*width:(i+1)*width])
+        rows.append([row[0]]*rw + row + [row[-1]]*rw)
+    return rows
+
+
+# pure Python correlation backend
+# every row is padded once, then each kernel weight is applied to a whole
+# output row at a time; every pixel still adds up its products in the same
+# order as multiply_array, so results are identical to the per-pixel version
+def correlate_python(image, kernel):
+    height = image['height']
+    width = image['width']
+    rh = len(kernel) // 2
+    rw = len(kernel[0]) // 2
+    rows = padded_rows(image, rw)
+
+    result = []
+    for i in range(height):
+        acc = [0]*width
+        for a in range(len(kernel)):
+            prow = rows[min(max(i+a-rh, 0), height-1)]
+            for b in range(len(kernel[0])):
+                weight = kernel[a][b]
+                if weight == 0:
+                    continue
+                acc = [v + p*weight for v, p in zip(acc, prow[b:b+width])]
+        result.extend(acc)
+    return result
+
+
+CORRELATION_BACKENDS = {'python': correlate_python}
+correlation_backend = 'python'
+
+
+# selects the backend used by correlate when none is given
+def set_correlation_backend(name):
+    global correlation_backend
+    if name not in CORRELATION_BACKENDS:
+        raise ValueError('Unknown correlation backend: %r' % name)
+    correlation_backend = name
+
 # returns subarray of image with x,y coordinate at center and size that matches kernel size
 # default kernel is identity matrix
 def get_subarray(image, x, y, kernel=[[0,0,0],[0,1,0],[0,0,0]]):
@@ -129,17 +301,17 @@ def round_and_clip_image(image):
     255 in the output; and any locations with values lower than 0 in the input
     should have value 0 in the output.
     """
-    for x in range(len(image['pixels'])):
-        val = image['pixels'][x]
-        image['pixels'][x] = round(val)
-        if val > 255:
-            image['pixels'][x] = 255
-        elif val < 0:
-            image['pixels'][x] = 0
-
+    image['pixels'][:] = clipped_bytes(image['pixels'])
     return image
 
 
+# output sink for filters: rounds and clips values straight into a byte buffer
+# as they are produced, so no list of rounded ints is built first
+# (same values as round_and_clip_image; round() rounds halves to even)
+def clipped_bytes(values):
+    return bytearray(255 if v > 255 else 0 if v < 0 else round(v) for v in values)
+
+
 # FILTERS
 
 def blurred(image, n, clip=True):
@@ -150,21 +322,70 @@ def blurred(image, n, clip=True):
     This process should not mutate the input image; rather, it should create a
     separate structure to represent the output.
     """
-    # first, create a representation for the appropriate n-by-n kernel (you may
-    # wish to define another helper function for this)
-    kernel = blurred_kernel(n)
+    # odd kernel sizes use the running-sum box blur, which costs the same
+    # for every n; other sizes go through the general correlation
+    # the clipped box blur rounds and clips each row as it is produced
+    if n % 2 == 1:
+        if clip is True:
+            return image_like(image, box_blur(image, n, clip=True))
+        return {'height': image['height'],
+                'width': image['width'],
+                'pixels': box_blur(image, n)}
 
-    # then compute the correlation of the input image with that kernel
+    kernel = blurred_kernel(n)
     mod_image = correlate(image, kernel)
 
-    # and, finally, make sure that the output is a valid image (using the
-    # helper function from above) before returning it.
+    # and, finally, make sure that the output is a valid image before
+    # returning it.
     if clip is True:
-        return round_and_clip_image(mod_image)
+        return image_like(image, clipped_bytes(mod_image['pixels']))
     else:
         return mod_image
 
 
+# box blur of odd size n using running sums, O(1) work per pixel for any n
+# a horizontal pass sums each row over n columns, then a vertical pass sums
+# those row sums over n rows; edges are extended exactly like get_pixel
+# returns the unrounded blurred values as a flat list of pixels, or with
+# clip=True, the rounded and clipped values as a bytearray
+def box_blur(image, n, clip=False):
+    height = image['height']
+    width = image['width']
+    pixels = image['pixels']
+    r = n // 2
+
+    # horizontal pass: window sums over each row
+    row_sums = []
+    for i in range(height):
+        row = pixels[i*width:(i+1)*width]
+        padded = [row[0]]*r + list(row) + [row[-1]]*r
+        total = sum(padded[:n])
+        sums = [total]
+        for j in range(1, width):
+            total += padded[j+n-1] - padded[j-1]
+            sums.append(total)
+        row_sums.append(sums)
+
+    # vertical pass: slide a window of n row sums down the image
+    acc = [0]*width
+    for i in range(-r, r+1):
+        acc = [a + b for a, b in zip(acc, row_sums[min(max(i, 0), height-1)])]
+
+    area = n*n
+    result = bytearray() if clip else []
+    for i in range(height):
+        if clip:
+            result += clipped_bytes(a / area for a in acc)
+        else:
+            result.extend([a / area for a in acc])
+        if i + 1 < height:
+            add = row_sums[min(i+1+r, height-1)]
+            sub = row_sums[max(i-r, 0)]
+            acc = [a + p - m for a, p, m in zip(acc, add, sub)]
+
+    return result
+
+
 # creates kernel of size nxn
 # each val is 1/n**2
 def blurred_kernel(n):
@@ -184,35 +405,39 @@ def blurred_kernel(n):
 def sharpened(image, n):
     # use blurred function, without rounding
     blurred_im = blurred(image,n,clip=False)
-
-    result = {
-        'height': image['height'],
-        'width': image['width'],
-        'pixels': [],
-    }
-    for x in range(len(image['pixels'])):
-        result['pixels'].append(2*image['pixels'][x] - blurred_im['pixels'][x])
-
-    return round_and_clip_image(result)
-
-# produce two difference correlations
-# for each pixel, calculate resulting value from combining the two correlations
-def edges(image):
-    kx = [[-1,0,1],[-2,0,2],[-1,0,1]]
-    ky = [[-1,-2,-1],[0,0,0],[1,2,1]]
-
-    corr1 = correlate(image, kx)
-    corr2 = correlate(image, ky)
-
-    result = {
-        'height': image['height'],
-        'width': image['width'],
-        'pixels': []}
-
-    for x in range(len(image['pixels'])):
-        result['pixels'].append(round(math.sqrt((corr1['pixels'][x]**2)+(corr2['pixels'][x])**2)))
-
-    return round_and_clip_image(result)
+    values = (2*p - b for p, b in zip(image['pixels'], blurred_im['pixels']))
+
+    # rounded and clipped as they are computed
+    return image_like(image, clipped_bytes(values))
+
+# Sobel edge detection fused into a single pass
+# each 3x3 neighborhood is read once to get both gradients
+#   kx = [[-1,0,1],[-2,0,2],[-1,0,1]]
+#   ky = [[-1,-2,-1],[0,0,0],[1,2,1]]
+# and the rounded, clipped magnitude is written straight into the output
+# squared=True skips the square root and returns the unclipped squared
+# magnitude (a dictionary image), which is enough when only ranking matters
+def edges(image, squared=False):
+    height = image['height']
+    width = image['width']
+    rows = padded_rows(image, 1)
+
+    result = [] if squared else bytearray()
+    for i in range(height):
+        up = rows[max(i-1, 0)]
+        mid = rows[i]
+        down = rows[min(i+1, height-1)]
+        for a, b, c, d, f, g, h, k in zip(up, up[1:], up[2:], mid, mid[2:], down, down[1:], down[2:]):
+            gx = c - a + 2*(f - d) + k - g
+            gy = g - a + 2*(h - b) + k - c
+            if squared:
+                result.append(gx*gx + gy*gy)
+            else:
+                result.append(min(round(math.sqrt(gx*gx + gy*gy)), 255))
+
+    if squared:
+        return {'height': height, 'width': width, 'pixels': result}
+    return image_like(image, result)
 
 
 # HELPER FUNCTIONS FOR LOADING AND SAVING IMAGES
@@ -241,6 +466,25 @@ def load_image(filename):
         return {'height': h, 'width': w, 'pixels': pixels}
 
 
+# same as load_image, but returns a CompactImage
+# PIL hands the pixel data over as bytes, so no list of ints is ever built
+def load_compact_image(filename):
+    with open(filename, 'rb') as img_handle:
+        img = Image.open(img_handle)
+        if img.mode.startswith('RGB'):
+            r, g, b = [band.tobytes() for band in img.convert('RGB').split()]
+            data = bytearray(round(.299 * rv + .587 * gv + .114 * bv)
+                             for rv, gv, bv in zip(r, g, b))
+        elif img.mode == 'LA':
+            data = bytearray(img.getchannel('L').tobytes())
+        elif img.mode == 'L':
+            data = bytearray(img.tobytes())
+        else:
+            raise ValueError('Unsupported image mode: %r' % img.mode)
+        w, h = img.size
+        return CompactImage(h, w, data)
+
+
 def save_image(image, filename, mode='PNG'):
     """
     Saves the given image to disk or to a file-like object.  If filename is
@@ -248,8 +492,11 @@ def save_image(image, filename, mode='PNG'):
     filename is given as a file-like object, the file type will be determined
     by the 'mode' parameter.
     """
-    out = Image.new(mode='L', size=(image['width'], image['height']))
-    out.putdata(image['pixels'])
+    if isinstance(image, CompactImage):
+        out = Image.frombytes('L', (image.width, image.height), bytes(image.data))
+    else:
+        out = Image.new(mode='L', size=(image['width'], image['height']))
+        out.putdata(image['pixels'])
     if isinstance(filename, str):
         out.save(filename)
     else:
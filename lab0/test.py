@@ -162,5 +162,45 @@ class TestFilters(Lab0Test):
         expected = {'height': 11, 'width': 11, 'pixels': [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 255, 255, 255, 0, 0, 0, 0, 0, 0, 0, 0, 255, 0, 255, 0, 0, 0, 0, 0, 0, 0, 0, 255, 255, 255, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]}
         return self.compare_images(lab.edges(im),expected)
 
+
+class TestCompactImage(Lab0Test):
+    def setUp(self):
+        self.im = {'height': 5, 'width': 6, 'pixels': [(7*i*i + 3*i) % 256 for i in range(30)]}
+
+    def test_round_trip(self):
+        compact = lab.CompactImage.from_dict(self.im)
+        self.assertEqual(compact.to_dict(), self.im)
+        self.assertEqual(compact['pixels'][7], self.im['pixels'][7])
+
+    def test_filters_match_dictionary_form(self):
+        compact = lab.CompactImage.from_dict(self.im)
+        for filt in (lab.inverted, lab.edges, lambda i: lab.blurred(i, 3), lambda i: lab.sharpened(i, 3)):
+            result = filt(compact)
+            self.assertIsInstance(result, lab.CompactImage)
+            self.compare_images(result.to_dict(), filt(self.im))
+
+
+class TestBoxBlur(Lab0Test):
+    def test_box_blur_matches_kernel(self):
+        im = {'height': 7, 'width': 4, 'pixels': [(31*i + 17) % 256 for i in range(28)]}
+        for n in (1, 3, 5, 11):
+            with self.subTest(n=n):
+                expected = lab.correlate(im, lab.blurred_kernel(n))
+                for i, j in zip(lab.box_blur(im, n), expected['pixels']):
+                    self.assertAlmostEqual(i, j)
+                self.compare_images(lab.blurred(im, n), lab.round_and_clip_image(expected))
+
+
+class TestFusedEdges(Lab0Test):
+    def test_edges_match_two_correlations(self):
+        im = {'height': 5, 'width': 8, 'pixels': [(97*i*i + 5) % 256 for i in range(40)]}
+        gx = lab.correlate(im, [[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]])['pixels']
+        gy = lab.correlate(im, [[-1, -2, -1], [0, 0, 0], [1, 2, 1]])['pixels']
+        expected = {'height': 5, 'width': 8,
+                    'pixels': [min(round((x*x + y*y)**0.5), 255) for x, y in zip(gx, gy)]}
+        self.compare_images(lab.edges(im), expected)
+        self.assertEqual(lab.edges(im, squared=True)['pixels'], [x*x + y*y for x, y in zip(gx, gy)])
+
+
 if __name__ == '__main__':
     res = unittest.main(verbosity=3, exit=False)
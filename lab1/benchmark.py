@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+'''
+Benchmarks for the image filters in lab0 and lab1.
+
+Times each public filter on synthetic images of growing size (best of a few
+runs), once per correlation backend where the lab has them, and records the
+peak memory each call allocates.  Results are written as JSON so two runs
+(say, before and after a change) can be compared:
+
+    python benchmark.py --out before.json
+    ... change lab.py ...
+    python benchmark.py --out after.json --compare before.json
+
+Sizes default to 64..512; pass --sizes 64,128,256,512,1024,2048,4096 for the
+full scaling curve (slow in pure Python).
+'''
+
+import os
+import json
+import time
+import random
+import argparse
+import platform
+import importlib.util
+import subprocess
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_SIZES = [64, 128, 256, 512]
+
+# seam carving is quadratic in the width (one seam per column removed), so it
+# is only run up to this size unless --max-seam-size says otherwise
+MAX_SEAM_SIZE = 256
+
+
+# loads lab0/lab.py or lab1/lab.py as a module
+def load_lab(name):
+    spec = importlib.util.spec_from_file_location(name + '_lab', os.path.join(os.path.dirname(HERE), name, 'lab.py'))
+    lab = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(lab)
+    return lab
+
+
+# deterministic test images: smooth gradients with some noise and edges, so
+# blurs and edge detectors have something realistic to work on
+def synthetic_greyscale(size, seed=0):
+    rng = random.Random(seed)
+    pixels = []
+    for r in range(size):
+        for c in range(size):
+            value = (r + c) * 255 // (2 * size) + rng.randint(-20, 20)
+            if (r // 16 + c // 16) % 2:
+                value += 60
+            pixels.append(min(max(value, 0), 255))
+    return {'height': size, 'width': size, 'pixels': pixels}
+
+
+def synthetic_color(size, seed=0):
+    planes = [synthetic_greyscale(size, seed + c)['pixels'] for c in range(3)]
+    return {'height': size, 'width': size, 'pixels': list(zip(*planes))}
+
+
+# (name, function of the image, wants a color image, only for small sizes)
+def benchmark_cases(lab):
+    cases = [('inverted', lambda im: lab.inverted(im), False, False)]
+    for n in (3, 9, 25):
+        cases.append(('blurred(%d)' % n, lambda im, n=n: lab.blurred(im, n), False, False))
+    cases.append(('sharpened(5)', lambda im: lab.sharpened(im, 5), False, False))
+    cases.append(('edges', lambda im: lab.edges(im), False, False))
+    if hasattr(lab, 'emboss'):
+        cases.append(('emboss(3)', lambda im: lab.emboss(im, 3), True, False))
+    if hasattr(lab, 'threshold'):
+        cases.append(('threshold', lambda im: lab.threshold(im), False, False))
+    if hasattr(lab, 'seam_carving'):
+        cases.append(('seam_carving(8)', lambda im: lab.seam_carving(im, 8), True, True))
+    return cases
+
+
+def backends(lab):
+    if hasattr(lab, 'CORRELATION_BACKENDS'):
+        return sorted(lab.CORRELATION_BACKENDS)
+    return ['python']
+
+
+# best wall time of repeat calls, and the peak memory allocated by one call
+def measure(func, image, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(image)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    func(image)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_benchmarks(lab_name='lab1', sizes=DEFAULT_SIZES, repeat=3,
+                   max_seam_size=MAX_SEAM_SIZE, only=None, verbose=False):
+    lab = load_lab(lab_name)
+    results = []
+    for backend in backends(lab):
+        if hasattr(lab, 'set_correlation_backend'):
+            lab.set_correlation_backend(backend)
+        for name, func, color, small in benchmark_cases(lab):
+            if only and not any(o in name for o in only):
+                continue
+            for size in sizes:
+                if small and size > max_seam_size:
+                    continue
+                image = synthetic_color(size) if color else synthetic_greyscale(size)
+                seconds, peak = measure(func, image, repeat)
+                result = {'lab': lab_name, 'filter': name, 'backend': backend, 'size': size,
+                          'seconds': seconds, 'peak_bytes': peak}
+                results.append(result)
+                if verbose:
+                    print('%-16s %-7s %5d  %9.4fs  %8.1f KiB' % (name, backend, size, seconds, peak / 1024))
+    return {'meta': {'commit': git_commit(), 'python': platform.python_version(),
+                     'machine': platform.machine(), 'repeat': repeat},
+            'results': results}
+
+
+# pairs up the results of two runs and gives the speedup of new over old
+# (above 1 is faster) for every filter, backend and size both have
+def compare(old, new):
+    def key(result):
+        return (result['lab'], result['filter'], result['backend'], result['size'])
+    before = {key(result): result for result in old['results']}
+    rows = []
+    for result in new['results']:
+        if key(result) in before:
+            base = before[key(result)]
+            rows.append(key(result) + (base['seconds'] / result['seconds'] if result['seconds'] else float('inf'),
+                                       result['peak_bytes'] / base['peak_bytes'] if base['peak_bytes'] else 1.0))
+    return rows
+
+
+def print_comparison(rows, tolerance=0.1):
+    for lab, name, backend, size, speedup, memory in rows:
+        flag = ''
+        if speedup < 1 - tolerance:
+            flag = '  SLOWER'
+        elif speedup > 1 + tolerance:
+            flag = '  faster'
+        print('%-5s %-16s %-7s %5d  x%.2f time  x%.2f memory%s' % (lab, name, backend, size, speedup, memory, flag))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the lab image filters.')
+    parser.add_argument('--lab', default='lab1', choices=['lab0', 'lab1'])
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help='comma separated image sizes (square)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--max-seam-size', type=int, default=MAX_SEAM_SIZE)
+    parser.add_argument('--only', action='append', help='only run filters whose name contains this')
+    parser.add_argument('--out', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(args.lab, [int(size) for size in args.sizes.split(',')], args.repeat,
+                            args.max_seam_size, args.only, verbose=True)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(compare(json.load(f), report))
+
+
+if __name__ == '__main__':
+    main()
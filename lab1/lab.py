@@ -6,10 +6,27 @@ Spring 2020
 
 #!/usr/bin/env python3
 
+import os
 import math
-
+import time
+import array
+import hashlib
+import functools
+import threading
+import multiprocessing
+
+from itertools import accumulate
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from multiprocessing import shared_memory
 from PIL import Image
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # VARIOUS FILTERS
 
 '''LAB0 Code
@@ -34,32 +51,143 @@ def get_pixel(image, x, y):
     return image['pixels'][row*image['width']+col]
 
 
+# image stored in one contiguous bytearray instead of a list of ints (or tuples)
+# greyscale images use one byte per pixel
+# color images are stored planar: all red values, then all green, then all blue
+# indexing with 'height', 'width' or 'pixels' behaves like the dictionary form,
+# so every function that reads image['pixels'] also accepts a CompactImage
+class CompactImage:
+    def __init__(self, height, width, data=None, channels=1):
+        size = height * width * channels
+        if data is None:
+            data = bytearray(size)
+        if len(data) != size:
+            raise ValueError('Expected %d bytes of pixel data, got %d' % (size, len(data)))
+        self.height = height
+        self.width = width
+        self.channels = channels
+        self.data = data
+
+    # build from the dictionary form (pixels are ints or (r, g, b) tuples)
+    @classmethod
+    def from_dict(cls, image):
+        if isinstance(image, CompactImage):
+            return image
+        pixels = image['pixels']
+        if pixels and isinstance(pixels[0], tuple):
+            n = len(pixels)
+            data = bytearray(3 * n)
+            for c in range(3):
+                data[c * n:(c + 1) * n] = bytes(p[c] for p in pixels)
+            return cls(image['height'], image['width'], data, 3)
+        return cls(image['height'], image['width'], bytearray(pixels))
+
+    # export to the dictionary form
+    def to_dict(self):
+        if self.channels == 1:
+            pixels = list(self.data)
+        else:
+            pixels = list(zip(*self.planes()))
+        return {'height': self.height, 'width': self.width, 'pixels': pixels}
+
+    # zero-copy view of one channel
+    def plane(self, c):
+        n = self.height * self.width
+        return memoryview(self.data)[c * n:(c + 1) * n]
+
+    def planes(self):
+        return [self.plane(c) for c in range(self.channels)]
+
+    # greyscale CompactImage sharing the buffer of one channel
+    def channel_image(self, c):
+        return CompactImage(self.height, self.width, self.plane(c))
+
+    def copy(self):
+        return CompactImage(self.height, self.width, bytearray(self.data), self.channels)
+
+    def keys(self):
+        return ('height', 'width', 'pixels')
+
+    def __getitem__(self, key):
+        if key == 'height':
+            return self.height
+        if key == 'width':
+            return self.width
+        if key == 'pixels':
+            if self.channels == 1:
+                return self.data
+            return self.to_dict()['pixels']
+        raise KeyError(key)
+
+    def __len__(self):
+        return self.height * self.width
+
+    def __repr__(self):
+        return 'CompactImage(height=%d, width=%d, channels=%d)' % (self.height, self.width, self.channels)
+
+
+# returns a new image of the same kind as image (dictionary or CompactImage)
+# pixels must be integers in [0, 255] if image is a CompactImage
+def image_like(image, pixels):
+    if isinstance(image, CompactImage):
+        if not isinstance(pixels, bytearray):
+            pixels = bytearray(pixels)
+        return CompactImage(image['height'], image['width'], pixels)
+    if not isinstance(pixels, list):
+        pixels = list(pixels)
+    return {'height': image['height'], 'width': image['width'], 'pixels': pixels}
+
+
 def set_pixel(image, x, y, c):
     #print(image['pixels'][x*image['width']+y])
     image['pixels'][x*image['width']+y] = c
 
 
+# images with at least this many pixels are mapped through a lookup table
+LUT_MIN_PIXELS = 1024
+
+
+# the 256 values func gives for the pixel values of an 8-bit image, as bytes
+# if they are all in [0, 255] themselves (None if func fails on some of them)
+def point_table(func):
+    try:
+        table = [func(v) for v in range(256)]
+    except Exception:
+        return None
+    try:
+        return bytes(table)
+    except (TypeError, ValueError):
+        return table
+
+
+# pixels are visited in row-major order, the same order as the pixels list
+# an 8-bit image only has 256 different values, so for big images func is
+# called once per value and the pixels are mapped through the table instead
 def apply_per_pixel(image, func):
-    result = {
-        'height': image['height'],
-        'width': image['width'],
-        'pixels': [],
-    }
-    for x in range(image['height']):
-        for y in range(image['width']):
-            color = get_pixel(image, x, y)
-            newcolor = func(color)
-            result['pixels'].append(newcolor)
-    return result
+    pixels = image['pixels']
+    if len(pixels) >= LUT_MIN_PIXELS:
+        try:
+            data = pixels if isinstance(pixels, (bytes, bytearray)) else bytes(pixels)
+        except (TypeError, ValueError):
+            data = None
+        table = point_table(func) if data is not None else None
+        if isinstance(table, bytes):
+            return image_like(image, data.translate(table))
+        if table is not None:
+            return image_like(image, [table[v] for v in data])
+    return image_like(image, [func(color) for color in pixels])
 
 
 def inverted(image):
-    return apply_per_pixel(image, lambda c: 255-c)
+    return apply_per_pixel(image, inverted.point)
+
+# the function applied to each pixel, for filters that only map pixel values
+inverted.point = lambda c: 255-c
 
 
 # HELPER FUNCTIONS
 
-def correlate(image, kernel):
+def correlate(image, kernel, backend=None, method=None):
     """
     Compute the result of correlating the given image with the given kernel.
 
@@ -72,12 +200,31 @@ def correlate(image, kernel):
     separate structure to represent the output.
 
     Kernel represented by 2D array
-    """
-    updated_pixels = []
 
-    for x in range(image['height']):
-        for y in range(image['width']):
-            updated_pixels.append(multiply_array(get_subarray(image, x, y, kernel),kernel))
+    backend names one of CORRELATION_BACKENDS; by default the backend chosen
+    with set_correlation_backend is used.  method names one of
+    CORRELATION_METHODS ('direct', 'separable', 'fft' or 'auto'); by default
+    the one chosen with set_correlation_method is used
+    """
+    if backend is None:
+        backend = correlation_backend
+    if backend not in CORRELATION_BACKENDS:
+        raise ValueError('Unknown correlation backend: %r' % backend)
+    if method is None:
+        method = correlation_method
+    if method not in CORRELATION_METHODS:
+        raise ValueError('Unknown correlation method: %r' % method)
+
+    # kernels without a center pixel keep the original element-by-element path
+    if len(kernel) % 2 == 0 or len(kernel[0]) % 2 == 0:
+        updated_pixels = []
+        for x in range(image['height']):
+            for y in range(image['width']):
+                updated_pixels.append(multiply_array(get_subarray(image, x, y, kernel),kernel))
+    else:
+        if method == 'auto':
+            method = choose_correlation_method(kernel, backend)
+        updated_pixels = CORRELATION_METHODS[method](image, kernel, backend)
 
     im = {  'height': image['height'],
             'width': image['width'],
@@ -85,6 +232,222 @@ def correlate(image, kernel):
 
     return im
 
+
+# returns every row of the image padded by rw columns on each side,
+# repeating the edge pixels the same way get_pixel does
+def padded_rows(image, rw):
+    height = image['height']
+    width = image['width']
+    pixels = image['pixels']
+    rows = []
+    for i in range(height):
+        row = list(pixels[i*width:(i+1)*width])
+        rows.append([row[0]]*rw + row + [row[-1]]*rw)
+    return rows
+
+
+# pure Python correlation backend
+# every row is padded once, then each kernel weight is applied to a whole
+# output row at a time; every pixel still adds up its products in the same
+# order as multiply_array, so results are identical to the per-pixel version
+def correlate_python(image, kernel):
+    height = image['height']
+    width = image['width']
+    rh = len(kernel) // 2
+    rw = len(kernel[0]) // 2
+    rows = padded_rows(image, rw)
+
+    result = []
+    for i in range(height):
+        acc = [0]*width
+        for a in range(len(kernel)):
+            prow = rows[min(max(i+a-rh, 0), height-1)]
+            for b in range(len(kernel[0])):
+                weight = kernel[a][b]
+                if weight == 0:
+                    continue
+                acc = [v + p*weight for v, p in zip(acc, prow[b:b+width])]
+        result.extend(acc)
+    return result
+
+
+# NumPy correlation backend
+# pads the image once with edge replication (same clamping as get_pixel) and
+# adds up one shifted copy of the whole image per kernel weight, in the same
+# order as multiply_array, so results are identical to the Python backend
+def correlate_numpy(image, kernel):
+    height = image['height']
+    width = image['width']
+    pixels = image['pixels']
+    if isinstance(pixels, (bytearray, bytes, memoryview)):
+        arr = numpy.frombuffer(pixels, dtype=numpy.uint8).astype(numpy.int64)
+    else:
+        arr = numpy.array(pixels)
+    rh = len(kernel) // 2
+    rw = len(kernel[0]) // 2
+    padded = numpy.pad(arr.reshape(height, width), ((rh, rh), (rw, rw)), mode='edge')
+
+    acc = numpy.zeros((height, width), dtype=numpy.int64)
+    for a in range(len(kernel)):
+        for b in range(len(kernel[0])):
+            weight = kernel[a][b]
+            if weight == 0:
+                continue
+            acc = acc + padded[a:a+height, b:b+width] * weight
+    return acc.ravel().tolist()
+
+
+CORRELATION_BACKENDS = {'python': correlate_python}
+if numpy is not None:
+    CORRELATION_BACKENDS['numpy'] = correlate_numpy
+correlation_backend = 'numpy' if numpy is not None else 'python'
+
+
+# selects the backend used by correlate when none is given
+def set_correlation_backend(name):
+    global correlation_backend
+    if name not in CORRELATION_BACKENDS:
+        raise ValueError('Unknown correlation backend: %r' % name)
+    correlation_backend = name
+
+
+# CORRELATION METHODS
+# how correlate carries out a correlation with an odd-sized kernel:
+#   direct    - the backend adds up one product per kernel weight (exact)
+#   separable - a kernel that is an outer product col x row (rank 1, like the
+#               box blur) is applied as a 1 x k pass and then a k x 1 pass
+#   fft       - multiplies the Fourier transforms of the edge-padded image and
+#               the flipped kernel (needs NumPy); cost hardly depends on the
+#               kernel size
+#   auto      - direct for kernels of up to AUTO_MIN_WEIGHTS weights (so small
+#               kernels give exactly the same results as always), otherwise
+#               whichever the cost model below expects to be cheapest
+# separable and fft add up the products in a different order than direct, so
+# they agree with it up to correlation_tolerance(kernel) before clipping; a
+# value that is exactly halfway between two integers may then round the other
+# way.  So direct stays the default, and auto has to be asked for with
+# set_correlation_method('auto') (or method='auto')
+
+def correlate_direct(image, kernel, backend):
+    return CORRELATION_BACKENDS[backend](image, kernel)
+
+
+def correlate_separable(image, kernel, backend):
+    factors = separate_kernel(kernel)
+    if factors is None:
+        raise ValueError('kernel is not separable (rank 1)')
+    col, row = factors
+    rows_done = {'height': image['height'], 'width': image['width'],
+                 'pixels': CORRELATION_BACKENDS[backend](image, [row])}
+    return CORRELATION_BACKENDS[backend](rows_done, [[c] for c in col])
+
+
+# smallest n' >= n whose only prime factors are 2, 3 and 5 (fast FFT sizes)
+def fast_fft_length(n):
+    best = None
+    power5 = 1
+    while True:
+        power35 = power5
+        while True:
+            m = power35
+            while m < n:
+                m *= 2
+            if best is None or m < best:
+                best = m
+            if power35 >= n:
+                break
+            power35 *= 3
+        if power5 >= n:
+            break
+        power5 *= 5
+    return best
+
+
+def correlate_fft(image, kernel, backend=None):
+    if numpy is None:
+        raise ValueError('the fft correlation method needs NumPy')
+    height = image['height']
+    width = image['width']
+    pixels = image['pixels']
+    if isinstance(pixels, (bytearray, bytes, memoryview)):
+        arr = numpy.frombuffer(pixels, dtype=numpy.uint8).astype(numpy.float64)
+    else:
+        arr = numpy.array(pixels, dtype=numpy.float64)
+    k = numpy.array(kernel, dtype=numpy.float64)
+    kh, kw = k.shape
+    padded = numpy.pad(arr.reshape(height, width), ((kh//2, kh//2), (kw//2, kw//2)), mode='edge')
+
+    # circular convolution with the flipped kernel; rows and columns from
+    # kh-1 and kw-1 on never wrap around, and they are exactly the correlation
+    shape = (fast_fft_length(padded.shape[0]), fast_fft_length(padded.shape[1]))
+    spectrum = numpy.fft.rfft2(padded, shape) * numpy.fft.rfft2(k[::-1, ::-1], shape)
+    result = numpy.fft.irfft2(spectrum, shape)[kh-1:kh-1+height, kw-1:kw-1+width]
+    return result.ravel().tolist()
+
+
+# (col, row) with kernel[i][j] == col[i] * row[j] (up to float rounding), or
+# None if the kernel is not an outer product
+def separate_kernel(kernel):
+    pivot = max(((abs(v), i, j) for i, r in enumerate(kernel) for j, v in enumerate(r)), default=(0, 0, 0))
+    size, p, q = pivot
+    if size == 0:
+        return None
+    row = list(kernel[p])
+    col = [kernel[i][q] / kernel[p][q] for i in range(len(kernel))]
+    for i, r in enumerate(kernel):
+        for j, v in enumerate(r):
+            if abs(col[i]*row[j] - v) > 1e-12 * size:
+                return None
+    return col, row
+
+
+CORRELATION_METHODS = {'direct': correlate_direct,
+                       'separable': correlate_separable,
+                       'fft': correlate_fft,
+                       'auto': None}
+correlation_method = 'direct'
+
+# auto never leaves direct for kernels with at most this many weights
+AUTO_MIN_WEIGHTS = 225
+
+# rough cost per pixel of an FFT correlation, in the units of FUSION_COSTS
+FFT_COST = 1.5
+
+
+# selects the method used by correlate when none is given
+def set_correlation_method(name):
+    global correlation_method
+    if name not in CORRELATION_METHODS:
+        raise ValueError('Unknown correlation method: %r' % name)
+    correlation_method = name
+
+
+# the method the cost model expects to be cheapest for kernel on backend
+def choose_correlation_method(kernel, backend=None):
+    if count_weights(kernel) <= AUTO_MIN_WEIGHTS:
+        return 'direct'
+    costs = correlation_costs(kernel, backend)
+    return min(costs, key=lambda method: costs[method])
+
+
+# estimated cost per pixel of each method that can run kernel on backend
+def correlation_costs(kernel, backend=None):
+    weight_cost, pass_cost = FUSION_COSTS.get(backend or correlation_backend, FUSION_COSTS['python'])
+    costs = {'direct': count_weights(kernel) * weight_cost}
+    factors = separate_kernel(kernel)
+    if factors is not None:
+        col, row = factors
+        costs['separable'] = (count_weights([col]) + count_weights([row])) * weight_cost + pass_cost
+    if numpy is not None:
+        costs['fft'] = FFT_COST
+    return costs
+
+
+# how far separable or fft results may be from direct ones (before clipping)
+# for pixel values in [0, 255]
+def correlation_tolerance(kernel):
+    return 1e-12 * (1 + 255 * sum(abs(v) for row in kernel for v in row))
+
 # returns subarray of image with x,y coordinate at center and size that matches kernel size
 # default kernel is identity matrix
 def get_subarray(image, x, y, kernel=[[0,0,0],[0,1,0],[0,0,0]]):
@@ -124,19 +487,25 @@ def round_and_clip_image(image):
     255 in the output; and any locations with values lower than 0 in the input
     should have value 0 in the output.
     """
-    for x in range(len(image['pixels'])):
-        val = image['pixels'][x]
-        image['pixels'][x] = round(val)
-        if val > 255:
-            image['pixels'][x] = 255
-        elif val < 0:
-            image['pixels'][x] = 0
-
+    image['pixels'][:] = clipped_bytes(image['pixels'])
     return image
 
 
+# output sink for filters: rounds and clips values straight into a byte buffer
+# as they are produced, so no list of rounded ints is built first
+# (same values as round_and_clip_image; round() rounds halves to even)
+def clipped_bytes(values):
+    return bytearray(255 if v > 255 else 0 if v < 0 else round(v) for v in values)
+
+
 # FILTERS
 
+# kernels and filter factories hand out the same object for the same
+# parameters instead of building a new one each time; this many of each are
+# kept (the least recently used go first)
+FACTORY_CACHE_SIZE = 128
+
+
 def blurred(image, n, clip=True):
     """
     Return a new image representing the result of applying a box blur (with
@@ -145,23 +514,172 @@ def blurred(image, n, clip=True):
     This process should not mutate the input image; rather, it should create a
     separate structure to represent the output.
     """
-    # first, create a representation for the appropriate n-by-n kernel (you may
-    # wish to define another helper function for this)
-    kernel = blurred_kernel(n)
+    # odd kernel sizes use the running-sum box blur, which costs the same
+    # for every n; other sizes go through the general correlation
+    # the clipped box blur rounds and clips each row as it is produced
+    if n % 2 == 1:
+        if clip is True:
+            return image_like(image, box_blur(image, n, clip=True))
+        return {'height': image['height'],
+                'width': image['width'],
+                'pixels': box_blur(image, n)}
 
-    # then compute the correlation of the input image with that kernel
+    kernel = blurred_kernel(n)
     mod_image = correlate(image, kernel)
 
-    # and, finally, make sure that the output is a valid image (using the
-    # helper function from above) before returning it.
+    # and, finally, make sure that the output is a valid image before
+    # returning it.
     if clip is True:
-        return round_and_clip_image(mod_image)
+        return image_like(image, clipped_bytes(mod_image['pixels']))
     else:
         return mod_image
 
 
+# box blur of odd size n using running sums, O(1) work per pixel for any n
+# a horizontal pass sums each row over n columns, then a vertical pass sums
+# those row sums over n rows; edges are extended exactly like get_pixel
+# returns the unrounded blurred values as a flat list of pixels, or with
+# clip=True, the rounded and clipped values as a bytearray
+def box_blur(image, n, clip=False):
+    height = image['height']
+    width = image['width']
+    pixels = image['pixels']
+    r = n // 2
+
+    # horizontal pass: window sums over each row
+    row_sums = []
+    for i in range(height):
+        row = pixels[i*width:(i+1)*width]
+        padded = [row[0]]*r + list(row) + [row[-1]]*r
+        total = sum(padded[:n])
+        sums = [total]
+        for j in range(1, width):
+            total += padded[j+n-1] - padded[j-1]
+            sums.append(total)
+        row_sums.append(sums)
+
+    # vertical pass: slide a window of n row sums down the image
+    acc = [0]*width
+    for i in range(-r, r+1):
+        acc = [a + b for a, b in zip(acc, row_sums[min(max(i, 0), height-1)])]
+
+    area = n*n
+    result = bytearray() if clip else []
+    for i in range(height):
+        if clip:
+            result += clipped_bytes(a / area for a in acc)
+        else:
+            result.extend([a / area for a in acc])
+        if i + 1 < height:
+            add = row_sums[min(i+1+r, height-1)]
+            sub = row_sums[max(i-r, 0)]
+            acc = [a + p - m for a, p, m in zip(acc, add, sub)]
+
+    return result
+
+
+# splits the range [start, start + count) of indices into the pieces that
+# fall inside [0, size), as (lo, hi, weight); like get_pixel, indices before
+# 0 stand for index 0 and indices past the end for index size-1, so those
+# become single-index pieces weighted by how often they are repeated
+def clamped_segments(start, count, size):
+    end = start + count
+    segments = []
+    before = min(end, 0) - start
+    if before > 0:
+        segments.append((0, 1, before))
+    lo = max(start, 0)
+    hi = min(end, size)
+    if hi > lo:
+        segments.append((lo, hi, 1))
+    after = end - max(start, size)
+    if after > 0:
+        segments.append((size-1, size, after))
+    return segments
+
+
+class IntegralImage:
+    """
+    Summed-area table of a greyscale image: sums[i][j] is the sum of all
+    pixels above and to the left of (i, j).  Built once in O(height*width),
+    it answers the sum or mean of any box in O(1), with pixels outside the
+    image extended from the edges exactly like get_pixel.  This lets one
+    table serve blurs of every size.
+    """
+    def __init__(self, image):
+        self.image = image
+        self.height = image['height']
+        self.width = image['width']
+        pixels = image['pixels']
+        w = self.width
+        prev = [0]*(w+1)
+        self.sums = [prev]
+        for i in range(self.height):
+            row = [0]
+            row.extend(accumulate(pixels[i*w:(i+1)*w]))
+            prev = [a + b for a, b in zip(prev, row)]
+            self.sums.append(prev)
+
+    # sum of the pixels in rows [row, row+nrows) and columns [col, col+ncols)
+    def box_sum(self, row, col, nrows, ncols):
+        sums = self.sums
+        total = 0
+        for top, bottom, row_weight in clamped_segments(row, nrows, self.height):
+            upper = sums[top]
+            lower = sums[bottom]
+            for left, right, col_weight in clamped_segments(col, ncols, self.width):
+                total += row_weight * col_weight * (lower[right] - upper[right] - lower[left] + upper[left])
+        return total
+
+    def box_mean(self, row, col, nrows, ncols):
+        return self.box_sum(row, col, nrows, ncols) / (nrows * ncols)
+
+    # column prefix sums of rows [row, row+nrows), edge rows repeated
+    def band(self, row, nrows):
+        band = [0]*(self.width+1)
+        for top, bottom, weight in clamped_segments(row, nrows, self.height):
+            band = [b + weight*(lower - upper) for b, upper, lower in zip(band, self.sums[top], self.sums[bottom])]
+        return band
+
+    def blurred(self, n, clip=True):
+        """
+        Same as blurred(image, n) for odd n, but read off the table: O(1)
+        work per pixel for any n.  Even n is not supported (blurred has no
+        centered nxn box for it).
+        """
+        if n % 2 == 0:
+            raise ValueError('IntegralImage only blurs with odd kernel sizes, got %d' % n)
+        r = n // 2
+        width = self.width
+        area = n*n
+        result = bytearray() if clip else []
+        for i in range(self.height):
+            band = self.band(i - r, n)
+            # prefix sums over columns -r .. width+r, edge columns repeated
+            first = band[1]
+            last = band[width] - band[width-1]
+            ext = [c*first for c in range(-r, 0)] + band + [band[width] + k*last for k in range(1, r+1)]
+            if clip:
+                result += clipped_bytes((b - a) / area for a, b in zip(ext, ext[n:]))
+            else:
+                result.extend([(b - a) / area for a, b in zip(ext, ext[n:])])
+        if clip:
+            return image_like(self.image, result)
+        return {'height': self.height, 'width': width, 'pixels': result}
+
+
+# blurs image with each size in sizes from one IntegralImage
+# returns a dictionary of size -> blurred image
+def blurred_sizes(image, sizes, clip=True):
+    table = IntegralImage(image)
+    return {n: table.blurred(n, clip) for n in sizes}
+
+
 # creates kernel of size nxn
 # each val is 1/n**2
+# kernels are built once per size and shared, so they are tuples (a caller
+# that wants to change one has to copy it first)
+@functools.lru_cache(maxsize=FACTORY_CACHE_SIZE)
 def blurred_kernel(n):
     val = 1/n**2
     kernel = []
@@ -169,43 +687,84 @@ def blurred_kernel(n):
         list = []
         for y in range(n):
             list.append(val)
-        kernel.append(list)
+        kernel.append(tuple(list))
 
-    return kernel
+    return tuple(kernel)
 
 # alters each pixel to 2*original pixel - blurred pixel
-def sharpened(image, n):
+def sharpened(image, n, clip=True):
     # use blurred function, without rounding
     blurred_im = blurred(image,n,clip=False)
+    values = (2*p - b for p, b in zip(image['pixels'], blurred_im['pixels']))
+
+    if not clip:
+        return {'height': image['height'], 'width': image['width'], 'pixels': list(values)}
+    # rounded and clipped as they are computed
+    return image_like(image, clipped_bytes(values))
+
+# Sobel edge detection fused into a single pass
+# each 3x3 neighborhood is read once to get both gradients
+#   kx = [[-1,0,1],[-2,0,2],[-1,0,1]]
+#   ky = [[-1,-2,-1],[0,0,0],[1,2,1]]
+# and the rounded, clipped magnitude is written straight into the output
+# squared=True skips the square root and returns the unclipped squared
+# magnitude (a dictionary image), which is enough when only ranking matters
+def edges(image, squared=False):
+    height = image['height']
+    width = image['width']
+    if correlation_backend == 'numpy':
+        result = edges_numpy(image, squared)
+        if result is not None:
+            return result
 
-    result = {
-        'height': image['height'],
-        'width': image['width'],
-        'pixels': [],
-    }
-    for x in range(len(image['pixels'])):
-        result['pixels'].append(2*image['pixels'][x] - blurred_im['pixels'][x])
-
-    return round_and_clip_image(result)
-
-# produce two difference correlations
-#for each pixel, calculate resulting value from combining the two correlations
-def edges(image):
-    kx = [[-1,0,1],[-2,0,2],[-1,0,1]]
-    ky = [[-1,-2,-1],[0,0,0],[1,2,1]]
+    rows = padded_rows(image, 1)
 
-    corr1 = correlate(image, kx)
-    corr2 = correlate(image, ky)
+    result = [] if squared else bytearray()
+    for i in range(height):
+        up = rows[max(i-1, 0)]
+        mid = rows[i]
+        down = rows[min(i+1, height-1)]
+        for a, b, c, d, f, g, h, k in zip(up, up[1:], up[2:], mid, mid[2:], down, down[1:], down[2:]):
+            gx = c - a + 2*(f - d) + k - g
+            gy = g - a + 2*(h - b) + k - c
+            if squared:
+                result.append(gx*gx + gy*gy)
+            else:
+                result.append(min(round(math.sqrt(gx*gx + gy*gy)), 255))
+
+    if squared:
+        return {'height': height, 'width': width, 'pixels': result}
+    return image_like(image, result)
+
+
+# NumPy version of the fused Sobel pass (used with the numpy backend)
+# numpy.rint rounds halves to even, exactly like Python's round
+# returns None for images with non-integer pixels (say, an unclipped blur),
+# which are left to the Python loop so the sums are added in the same order
+def edges_numpy(image, squared=False):
+    height = image['height']
+    width = image['width']
+    pixels = image['pixels']
+    if isinstance(pixels, (bytearray, bytes, memoryview)):
+        arr = numpy.frombuffer(pixels, dtype=numpy.uint8).astype(numpy.int64)
+    else:
+        arr = numpy.array(pixels)
+        if arr.dtype.kind not in 'iu':
+            return None
+        arr = arr.astype(numpy.int64)
+    p = numpy.pad(arr.reshape(height, width), 1, mode='edge')
 
-    result = {
-        'height': image['height'],
-        'width': image['width'],
-        'pixels': []}
+    gx = (p[:-2, 2:] - p[:-2, :-2]) + 2*(p[1:-1, 2:] - p[1:-1, :-2]) + (p[2:, 2:] - p[2:, :-2])
+    gy = (p[2:, :-2] - p[:-2, :-2]) + 2*(p[2:, 1:-1] - p[:-2, 1:-1]) + (p[2:, 2:] - p[:-2, 2:])
+    mag2 = gx*gx + gy*gy
+    if squared:
+        return {'height': height, 'width': width, 'pixels': mag2.ravel().tolist()}
+    mag = numpy.minimum(numpy.rint(numpy.sqrt(mag2)), 255).astype(numpy.int64)
+    return image_like(image, mag.ravel().tolist())
 
-    for x in range(len(image['pixels'])):
-        result['pixels'].append(round(math.sqrt((corr1['pixels'][x]**2)+(corr2['pixels'][x])**2)))
 
-    return round_and_clip_image(result)
+edges.radius = 1
+inverted.radius = 0
 
 
 # HELPER FUNCTIONS FOR LOADING AND SAVING IMAGES
@@ -222,8 +781,7 @@ def load_image(filename):
         img = Image.open(img_handle)
         img_data = img.getdata()
         if img.mode.startswith('RGB'):
-            pixels = [round(.299 * p[0] + .587 * p[1] + .114 * p[2])
-                      for p in img_data]
+            pixels = greyscale_pixels(*[band.tobytes() for band in img.convert('RGB').split()])
         elif img.mode == 'LA':
             pixels = [p[0] for p in img_data]
         elif img.mode == 'L':
@@ -234,6 +792,23 @@ def load_image(filename):
         return {'height': h, 'width': w, 'pixels': pixels}
 
 
+# same as load_image, but returns a CompactImage
+# PIL hands the pixel data over as bytes, so no list of ints is ever built
+def load_compact_image(filename):
+    with open(filename, 'rb') as img_handle:
+        img = Image.open(img_handle)
+        if img.mode.startswith('RGB'):
+            data = bytearray(greyscale_pixels(*[band.tobytes() for band in img.convert('RGB').split()]))
+        elif img.mode == 'LA':
+            data = bytearray(img.getchannel('L').tobytes())
+        elif img.mode == 'L':
+            data = bytearray(img.tobytes())
+        else:
+            raise ValueError('Unsupported image mode: %r' % img.mode)
+        w, h = img.size
+        return CompactImage(h, w, data)
+
+
 def save_image(image, filename, mode='PNG'):
     """
     Saves the given image to disk or to a file-like object.  If filename is
@@ -241,8 +816,33 @@ def save_image(image, filename, mode='PNG'):
     filename is given as a file-like object, the file type will be determined
     by the 'mode' parameter.
     """
-    out = Image.new(mode='L', size=(image['width'], image['height']))
-    out.putdata(image['pixels'])
+    write_image(image, filename, mode)
+
+
+# encodes and writes a greyscale (or, with color=True, color) image for
+# save_image and save_color_image, without printing anything
+def write_image(image, filename, mode='PNG', color=False):
+    size = (image['width'], image['height'])
+    if color:
+        if isinstance(image, CompactImage):
+            out = Image.merge('RGB', [Image.frombytes('L', size, bytes(plane)) for plane in image.planes()])
+        elif isinstance(image, PlanarImage):
+            out = Image.merge('RGB', [Image.frombytes('L', size, bytes(plane['pixels'])) for plane in image.planes])
+        else:
+            try:
+                out = Image.frombytes('RGB', size, bytes(v for p in image['pixels'] for v in p))
+            except (TypeError, ValueError):
+                # PIL takes no floats for color pixels, so round and clip them
+                out = Image.frombytes('RGB', size, bytes(clipped_bytes(v for p in image['pixels'] for v in p)))
+    elif isinstance(image, CompactImage):
+        out = Image.frombytes('L', size, bytes(image.data))
+    else:
+        try:
+            out = Image.frombytes('L', size, bytes(image['pixels']))
+        except (TypeError, ValueError):
+            # floats or values outside [0, 255] are left to PIL to convert
+            out = Image.new(mode='L', size=size)
+            out.putdata(image['pixels'])
     if isinstance(filename, str):
         out.save(filename)
     else:
@@ -250,6 +850,56 @@ def save_image(image, filename, mode='PNG'):
     out.close()
 
 
+# color image kept as three separate greyscale images (red, green, blue planes)
+# color filters run on the planes directly and return another PlanarImage, so
+# a chain of color filters never builds (r, g, b) tuples; the planes can be
+# dictionaries or CompactImages, and need not be rounded or clipped.
+# indexing with 'pixels' (or to_dict) exports the usual list of tuples
+class PlanarImage:
+    def __init__(self, planes):
+        self.planes = list(planes)
+        self.height = self.planes[0]['height']
+        self.width = self.planes[0]['width']
+
+    # split a color image (list of tuples, or a color CompactImage)
+    @classmethod
+    def from_image(cls, image):
+        if isinstance(image, PlanarImage):
+            return image
+        if isinstance(image, CompactImage):
+            return cls([image.channel_image(c) for c in range(image.channels)])
+        return cls(split_color(image))
+
+    def to_dict(self):
+        return combine_color(self.planes)
+
+    # a color CompactImage if every plane holds bytes (integers in [0, 255]),
+    # otherwise (floats, unclipped values) the dictionary form
+    def compact_or_dict(self):
+        data = bytearray()
+        try:
+            for plane in self.planes:
+                data += plane.data if isinstance(plane, CompactImage) else bytearray(plane['pixels'])
+        except (TypeError, ValueError):
+            return self.to_dict()
+        return CompactImage(self.height, self.width, data, len(self.planes))
+
+    def keys(self):
+        return ('height', 'width', 'pixels')
+
+    def __getitem__(self, key):
+        if key == 'height':
+            return self.height
+        if key == 'width':
+            return self.width
+        if key == 'pixels':
+            return self.to_dict()['pixels']
+        raise KeyError(key)
+
+    def __repr__(self):
+        return 'PlanarImage(height=%d, width=%d)' % (self.height, self.width)
+
+
 def color_filter_from_greyscale_filter(filt):
     """
     Given a filter that takes a greyscale image as input and produces a
@@ -257,29 +907,37 @@ def color_filter_from_greyscale_filter(filt):
     input and produces the filtered color image.
     """
     def color_filter(image):
-        r, g, b = split_color(image)
-        r = filt(r)
-        g = filt(g)
-        b = filt(b)
-
-        color = combine_color((r,g,b))
-
-        return color
+        # planar images are filtered one channel at a time without building tuples
+        if isinstance(image, PlanarImage):
+            return PlanarImage([filt(plane) for plane in image.planes])
+        # a color CompactImage stays compact while the channels come back as
+        # bytes; unclipped results (floats, values outside [0, 255]) are
+        # returned as a dictionary of tuples like the list form would give
+        if isinstance(image, CompactImage):
+            return color_filter(PlanarImage.from_image(image)).compact_or_dict()
+
+        # lists of tuples are split once and combined once
+        return color_filter(PlanarImage.from_image(image)).to_dict()
+
+    # a color version of a linear filter is still linear (channel by channel)
+    color_filter.greyscale_filter = filt
+    color_filter.name = 'color %s' % (getattr(filt, 'name', None) or getattr(filt, '__name__', repr(filt)))
+    if hasattr(filt, 'kernel'):
+        describe_linear(color_filter, filt.kernel, color_filter.name, filt.cost,
+                        offset=filt.offset, clip=filt.clip, to_grey=filt.to_grey, color=True)
 
     return color_filter
 
 # returns 3 seperate lists of r, g, b
 def split_color(image):
-    r = {'height': image['height'], 'width': image['width'], 'pixels': []}
-    g = {'height': image['height'], 'width': image['width'], 'pixels': []}
-    b = {'height': image['height'], 'width': image['width'], 'pixels': []}
-
-    for p in image['pixels']:
-        r['pixels'].append(p[0])
-        g['pixels'].append(p[1])
-        b['pixels'].append(p[2])
+    height = image['height']
+    width = image['width']
+    if image['pixels']:
+        planes = [list(plane) for plane in zip(*image['pixels'])]
+    else:
+        planes = [[], [], []]
 
-    return r, g, b
+    return tuple({'height': height, 'width': width, 'pixels': plane} for plane in planes)
 
 # takes tuple representing 3 images (r,g,b) and return a single image, combining all of them
 def combine_color(images):
@@ -287,75 +945,1428 @@ def combine_color(images):
     g = images[1]['pixels']
     b = images[2]['pixels']
 
-    color = {'height': images[0]['height'], 'width': images[0]['width'], 'pixels': []}
-
-    for x in range(len(r)):
-        color['pixels'].append((r[x], g[x], b[x]))
-
-    return color
+    return {'height': images[0]['height'], 'width': images[0]['width'], 'pixels': list(zip(r, g, b))}
 
 # create new function to blur images using one parameter
 # allows you to pass filter into color_filter_from_greyscale - can now blur colored images
-def make_blur_filter(n):
+# clip=False keeps the unrounded values, which lets filter_cascade fuse the blur
+# with the filters after it
+@functools.lru_cache(maxsize=FACTORY_CACHE_SIZE)
+def make_blur_filter(n, clip=True):
 
     def blur(image):
-        return blurred(image, n)
+        return blurred(image, n, clip)
 
+    # box blurs run as two running-sum passes, whatever the size
+    describe_linear(blur, blurred_kernel(n), 'blur(%d)' % n, 4, clip=clip)
     return blur
 
 
-def make_sharpen_filter(n):
+@functools.lru_cache(maxsize=FACTORY_CACHE_SIZE)
+def make_sharpen_filter(n, clip=True):
 
     def sharpen(image):
-        return sharpened(image, n)
+        return sharpened(image, n, clip)
 
+    kernel = [[-v for v in row] for row in blurred_kernel(n)]
+    kernel[n//2][n//2] += 2
+    describe_linear(sharpen, kernel, 'sharpen(%d)' % n, 6, clip=clip)
     return sharpen
 
 
+# emboss as a filter on color images (never clipped, like emboss)
+@functools.lru_cache(maxsize=FACTORY_CACHE_SIZE)
+def make_emboss_filter(n, direction='horizontal'):
+
+    def emboss_filter(image):
+        return emboss(image, n, direction)
+
+    kernel = emboss_kernel(n, direction)
+    describe_linear(emboss_filter, kernel, 'emboss(%d, %s)' % (n, direction), None,
+                    offset=128, clip=False, to_grey=True)
+    return emboss_filter
+
+
+# filter that correlates a greyscale image with any kernel
+def make_correlation_filter(kernel, clip=True):
+
+    def correlation(image):
+        result = correlate(image, kernel)
+        if not clip:
+            return result
+        return image_like(image, clipped_bytes(result['pixels']))
+
+    describe_linear(correlation, kernel, 'correlate(%dx%d)' % (len(kernel), len(kernel[0])), None, clip=clip)
+    return correlation
+
+
+# LINEAR FILTERS
+# filters that only correlate with a kernel (blur, sharpen, emboss, ...) are
+# marked with a description of what they compute, so filter_cascade can fuse
+# a run of them into a single correlation:
+#   kernel   - the correlation kernel
+#   offset   - constant added after correlating (emboss adds 128)
+#   clip     - whether the result is rounded and clipped to [0, 255]
+#   to_grey  - whether a color input is first converted to greyscale (emboss)
+#   color    - whether this is the color version of a greyscale filter
+#   cost     - rough cost per pixel of running the filter on its own, in
+#              kernel weights applied by the Python backend (None for filters
+#              that just call correlate)
+def describe_linear(filt, kernel, name, cost, offset=0, clip=True, to_grey=False, color=False):
+    filt.kernel = kernel
+    filt.name = name if clip or 'unclipped' in name else name + ' unclipped'
+    filt.cost = cost
+    filt.offset = offset
+    filt.clip = clip
+    filt.to_grey = to_grey
+    filt.color = color
+
+
+# rough cost per pixel of (applying one kernel weight, one extra full-image
+# pass) for each correlation backend, in the same units as filter costs
+FUSION_COSTS = {'python': (1, 4), 'numpy': (0.025, 4)}
+
+
+# kernel that correlates like correlating with k1 and then with k2
+def compose_kernels(k1, k2):
+    h = len(k1) + len(k2) - 1
+    w = len(k1[0]) + len(k2[0]) - 1
+    kernel = [[0]*w for i in range(h)]
+    for a in range(len(k1)):
+        for b in range(len(k1[0])):
+            if k1[a][b] == 0:
+                continue
+            for c in range(len(k2)):
+                for d in range(len(k2[0])):
+                    kernel[a+c][b+d] += k1[a][b] * k2[c][d]
+    return kernel
+
+
+def kernel_sum(kernel):
+    return sum(sum(row) for row in kernel)
+
+
+def count_weights(kernel):
+    return sum(1 for row in kernel for v in row if v != 0)
+
+
+# returns the part of an image with the given corner and size as a new image
+def crop_image(image, top, left, height, width):
+    pixels = image['pixels']
+    w = image['width']
+    result = []
+    for i in range(top, top+height):
+        result.extend(pixels[i*w+left:i*w+left+width])
+    return {'height': height, 'width': width, 'pixels': result}
+
+
+# applies filters one after another
+def run_filters(image, filters):
+    for filt in filters:
+        image = filt(image)
+    return image
+
+
+# one correlation equivalent to a run of linear filters, where every filter
+# but the last is unclipped and only the first may convert to greyscale
+# away from the edges the fused kernel gives the same values as the separate
+# filters (up to floating-point rounding); near the edges the separate
+# filters extend each intermediate image, so the border band (as wide as the
+# fused kernel's radius) is computed by running them on thin strips
+def make_fused_filter(filters):
+    kernel = filters[0].kernel
+    offset = filters[0].offset
+    for filt in filters[1:]:
+        kernel = compose_kernels(kernel, filt.kernel)
+        offset = offset*kernel_sum(filt.kernel) + filt.offset
+    clip = filters[-1].clip
+    to_grey = filters[0].to_grey
+    rh = len(kernel) // 2
+    rw = len(kernel[0]) // 2
+
+    def fused(image):
+        height = image['height']
+        width = image['width']
+        if height <= 4*rh or width <= 4*rw:
+            return run_filters(image, filters)
+
+        source = greyscale_image_from_color_image(image) if to_grey else image
+        pixels = correlate(source, kernel)['pixels']
+        if offset:
+            pixels = [v + offset for v in pixels]
+
+        # (top, left, height, width) of each strip and how many of its rows
+        # and columns (from the image edge) are kept
+        strips = []
+        if rh:
+            strips.append((0, 0, 2*rh, width, 'top'))
+            strips.append((height-2*rh, 0, 2*rh, width, 'bottom'))
+        if rw:
+            strips.append((0, 0, height, 2*rw, 'left'))
+            strips.append((0, width-2*rw, height, 2*rw, 'right'))
+        for top, left, h, w, side in strips:
+            part = run_filters(crop_image(image, top, left, h, w), filters)['pixels']
+            for i in range(h):
+                for j in range(w):
+                    if (side == 'top' and i < rh) or (side == 'bottom' and i >= rh) \
+                            or (side == 'left' and j < rw) or (side == 'right' and j >= rw):
+                        pixels[(top+i)*width + left+j] = part[i*w + j]
+
+        result = {'height': height, 'width': width, 'pixels': pixels}
+        if not clip:
+            return result
+        return image_like(source, clipped_bytes(result['pixels']))
+
+    describe_linear(fused, kernel, ' -> '.join(filt.name for filt in filters), None,
+                    offset=offset, clip=clip, to_grey=to_grey)
+    return fused
+
+
+# whether filt can be fused onto the end of the run of linear filters group
+def can_fuse(group, filt):
+    last = group[-1]
+    return (hasattr(filt, 'kernel') and not last.clip and not filt.to_grey
+            and filt.color == last.color
+            and len(filt.kernel) % 2 == 1 and len(filt.kernel[0]) % 2 == 1)
+
+
+# estimated cost per pixel of running a linear filter on its own
+def filter_cost(filt):
+    weight_cost, pass_cost = FUSION_COSTS.get(correlation_backend, FUSION_COSTS['python'])
+    if filt.cost is None:
+        return count_weights(filt.kernel) * weight_cost
+    return filt.cost
+
+
+# whether running group as one fused correlation is expected to be cheaper
+def fusion_pays_off(group):
+    weight_cost, pass_cost = FUSION_COSTS.get(correlation_backend, FUSION_COSTS['python'])
+    kernel = group[0].kernel
+    for filt in group[1:]:
+        kernel = compose_kernels(kernel, filt.kernel)
+    separate = sum(filter_cost(filt) for filt in group) + pass_cost*(len(group)-1)
+    if correlation_method == 'auto':
+        fused = correlation_costs(kernel)[choose_correlation_method(kernel)]
+    else:
+        fused = count_weights(kernel) * weight_cost
+    return fused <= separate
+
+
+# POINT FILTERS
+# filters that map every pixel value on its own (inverted, threshold) carry
+# that function as .point; a run of them is folded into one function, so the
+# cascade makes a single pass (and a single lookup table) for the whole run
+
+def is_point_filter(filt):
+    return hasattr(getattr(filt, 'greyscale_filter', filt), 'point')
+
+
+def make_point_filter(func, name='point'):
+
+    def point_filter(image):
+        return apply_per_pixel(image, func)
+
+    point_filter.point = func
+    point_filter.radius = 0
+    point_filter.name = name
+    return point_filter
+
+
+# one point filter doing what the point filters in group do in turn
+def fold_point_filters(group):
+    group = [getattr(filt, 'greyscale_filter', filt) for filt in group]
+    funcs = [filt.point for filt in group]
+
+    def folded(color):
+        for func in funcs:
+            color = func(color)
+        return color
+
+    names = [getattr(filt, 'name', getattr(filt, '__name__', 'point')) for filt in group]
+    return make_point_filter(folded, ', '.join(names))
+
+
+# splits filters into steps: single filters, runs of linear filters that are
+# fused into one correlation, or runs of point filters folded into one
+# returns a list of (description, filter) pairs
+def compile_cascade(filters):
+    groups = []
+    for filt in filters:
+        if groups and hasattr(groups[-1][0], 'kernel') and can_fuse(groups[-1], filt) \
+                and fusion_pays_off(groups[-1] + [filt]):
+            groups[-1].append(filt)
+        elif groups and is_point_filter(groups[-1][0]) and is_point_filter(filt) \
+                and hasattr(groups[-1][0], 'greyscale_filter') == hasattr(filt, 'greyscale_filter'):
+            groups[-1].append(filt)
+        else:
+            groups.append([filt])
+
+    steps = []
+    for group in groups:
+        if len(group) == 1:
+            filt = group[0]
+            steps.append((getattr(filt, 'name', getattr(filt, '__name__', repr(filt))), filt))
+            continue
+        if is_point_filter(group[0]):
+            step = fold_point_filters(group)
+            if hasattr(group[0], 'greyscale_filter'):
+                step = color_filter_from_greyscale_filter(step)
+            steps.append(('folded %s: one lookup table' % step.name, step))
+            continue
+        if group[0].color:
+            fused = make_fused_filter([filt.greyscale_filter for filt in group])
+            step = color_filter_from_greyscale_filter(fused)
+        else:
+            step = make_fused_filter(group)
+        kernel = step.kernel
+        steps.append(('fused %s: one %dx%d correlation%s' % (
+            step.name, len(kernel), len(kernel[0]), ', then round and clip' if step.clip else ''), step))
+    return steps
+
+
 def filter_cascade(filters):
     """
     Given a list of filters (implemented as functions on images), returns a new
     single filter such that applying that filter to an image produces the same
     output as applying each of the individual ones in turn.
+
+    Runs of linear filters (blur, sharpen, emboss, correlation filters) where
+    every filter but the last is unclipped are fused into one correlation when
+    that is expected to be cheaper; rounding and clipping then only happen at
+    the end of the run.  cascade.explain() describes the resulting plan.
     """
+    steps = compile_cascade(filters)
+
     def cascade(image):
-        image = image
-        for filter in filters:
+        # color images (lists of tuples or color CompactImages) stay planar
+        # between consecutive color filters and are only turned back into
+        # their own form when something else needs them
+        planar_input = isinstance(image, PlanarImage)
+        compact_input = isinstance(image, CompactImage)
+        for description, filter in steps:
+            if hasattr(filter, 'greyscale_filter'):
+                if isinstance(image, CompactImage):
+                    if image.channels > 1:
+                        image = PlanarImage.from_image(image)
+                elif not isinstance(image, PlanarImage) and image['pixels'] \
+                        and isinstance(image['pixels'][0], tuple):
+                    image = PlanarImage.from_image(image)
+            elif isinstance(image, PlanarImage):
+                image = image.compact_or_dict() if compact_input else image.to_dict()
             image = filter(image)
 
+        if isinstance(image, PlanarImage) and not planar_input:
+            image = image.compact_or_dict() if compact_input else image.to_dict()
         return image
 
+    def explain():
+        return '\n'.join('%d. %s' % (i+1, description) for i, (description, filt) in enumerate(steps))
+
+    cascade.explain = explain
+    radii = [filter_radius(filt) for filt in filters]
+    if None not in radii:
+        cascade.radius = sum(radii)
     return cascade
 
 
+# RESULT CACHE
+# pure filters give the same output for the same input, so results can be
+# kept and handed out again when the same image (by content) comes back
+
+# content hash of an image (dimensions, channels and pixel values)
+def image_digest(image):
+    digest = hashlib.blake2b(digest_size=16)
+    if isinstance(image, PlanarImage):
+        image = image.to_dict()
+    if isinstance(image, CompactImage):
+        digest.update(b'compact %d %d %d:' % (image.height, image.width, image.channels))
+        digest.update(image.data)
+        return digest.hexdigest()
+    digest.update(b'%d %d:' % (image['height'], image['width']))
+    pixels = image['pixels']
+    if pixels and isinstance(pixels[0], tuple):
+        digest.update(b'color:')
+        pixels = [v for p in pixels for v in p]
+    try:
+        digest.update(bytes(pixels))
+    except (TypeError, ValueError):
+        # floats, or ints outside [0, 255]
+        digest.update(repr(pixels).encode())
+    return digest.hexdigest()
+
+
+# rough number of bytes an image takes up in memory
+def image_nbytes(image):
+    if isinstance(image, CompactImage):
+        return len(image.data)
+    if isinstance(image, PlanarImage):
+        return sum(image_nbytes(plane) for plane in image.planes)
+    pixels = image['pixels']
+    if pixels and isinstance(pixels[0], tuple):
+        return 80 * len(pixels)
+    if pixels and isinstance(pixels[0], float):
+        return 32 * len(pixels)
+    return 8 * len(pixels)
+
+
+def copy_result(image):
+    if isinstance(image, PlanarImage):
+        return PlanarImage([copy_image(plane) for plane in image.planes])
+    return copy_image(image)
+
+
+class FilterCache:
+    """
+    Bounded LRU cache of filter results, keyed on (filter, params, digest of
+    the input image).  Holds at most max_bytes of results (estimated with
+    image_nbytes) and, if given, at most max_entries of them; the least
+    recently used results are dropped first.  Results are copied in and out,
+    so callers may change what they get back.  Only use it with pure filters.
+
+        cache = FilterCache(max_bytes=256 << 20)
+        blur = cache.wrap(make_blur_filter(5))
+        blur(image)                     # computed
+        blur(image)                     # from the cache
+        cache.apply(blurred, image, 5)  # any function of (image, *params)
+    """
+    def __init__(self, max_bytes=64 << 20, max_entries=None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def apply(self, filt, image, *params):
+        key = (filt, params, image_digest(image))
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return copy_result(self.entries[key][0])
+            self.misses += 1
+
+        result = filt(image, *params)
+        size = image_nbytes(result)
+        if size <= self.max_bytes:
+            with self.lock:
+                if key not in self.entries:
+                    self.entries[key] = (copy_result(result), size)
+                    self.nbytes += size
+                    self.evict()
+        return result
+
+    # drops least recently used results until the limits are met
+    def evict(self):
+        while self.entries and (self.nbytes > self.max_bytes or
+                                (self.max_entries is not None and len(self.entries) > self.max_entries)):
+            key, (result, size) = self.entries.popitem(last=False)
+            self.nbytes -= size
+            self.evictions += 1
+
+    # a filter that goes through the cache
+    def wrap(self, filt):
+
+        def cached_filter(image):
+            return self.apply(filt, image)
+
+        cached_filter.name = 'cached %s' % getattr(filt, 'name', getattr(filt, '__name__', 'filter'))
+        if hasattr(filt, 'radius'):
+            cached_filter.radius = filt.radius
+        return cached_filter
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self.entries), 'bytes': self.nbytes,
+                    'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return 'FilterCache(%d entries, %d bytes, %d hits, %d misses)' % (
+            len(self.entries), self.nbytes, self.hits, self.misses)
+
+
+# PARALLEL EXECUTION
+
+# how many rows around a pixel a filter reads (None if unknown)
+def filter_radius(filt):
+    if hasattr(filt, 'radius'):
+        return filt.radius
+    if hasattr(filt, 'kernel'):
+        return max(len(filt.kernel) // 2, len(filt.kernel[0]) // 2)
+    if hasattr(filt, 'greyscale_filter'):
+        return filter_radius(filt.greyscale_filter)
+    return None
+
+
+# state of a tiled worker process: (filter, input memory, output memory)
+# passed through the pool initializer, which (with the fork start method) is
+# inherited by the workers instead of pickled, so closures work as filters
+TILED_STATE = {}
+
+
+def set_tiled_state(filt, shm_in, shm_out, info):
+    TILED_STATE['filter'] = filt
+    TILED_STATE['in'] = shm_in
+    TILED_STATE['out'] = shm_out
+    TILED_STATE['info'] = info
+
+
+# filters that run in a TiledPool, by key; the workers of a pool know the
+# filters registered before it started
+TILED_FILTERS = {}
+
+
+# run_tile in a TiledPool worker, for the filter registered under key
+def run_pooled_tile(key, info, top, bottom):
+    TILED_STATE['filter'] = TILED_FILTERS[key]
+    TILED_STATE['info'] = info
+    return run_tile(top, bottom)
+
+
+class TiledPool:
+    """
+    Worker processes and shared buffers for tiled_filter, kept from one call
+    to the next instead of being set up for every image:
+
+        with TiledPool(4) as pool:
+            blur = tiled_filter(make_blur_filter(9), pool=pool)
+            process_images(paths, blur, 'out')
+
+    The workers are forked when the pool is first used, and inherit the
+    filters and buffers from then on.  The pool is only started again when a
+    filter the workers don't know comes along, or when an image needs bigger
+    buffers (which grow by at least half each time), so a batch of images of
+    one size through the same filters starts it once.  Needs the fork start
+    method; without it tiled_filter runs the strips in this process.
+    """
+    def __init__(self, workers=None):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.pool = None
+        self.filters = set()
+        self.shm_in = None
+        self.shm_out = None
+        self.starts = 0
+        self.lock = threading.Lock()
+        try:
+            self.context = multiprocessing.get_context('fork')
+        except ValueError:
+            self.context = None
+
+    # input and output buffers of at least these sizes, with workers that
+    # know the filter under key (restarting the pool if needed)
+    def buffers(self, key, in_size, out_size):
+        if (self.pool is None or key not in self.filters or
+                in_size > self.shm_in.size or out_size > self.shm_out.size):
+            in_size = max(in_size, self.shm_in.size * 3 // 2 if self.shm_in else 0)
+            out_size = max(out_size, self.shm_out.size * 3 // 2 if self.shm_out else 0)
+            self.close()
+            # sizes are kept to whole float64s so the output can be cast to 'd'
+            self.shm_in = shared_memory.SharedMemory(create=True, size=max(-(-in_size // 8) * 8, 8))
+            self.shm_out = shared_memory.SharedMemory(create=True, size=max(-(-out_size // 8) * 8, 8))
+            self.filters = set(TILED_FILTERS)
+            self.pool = self.context.Pool(self.workers, set_tiled_state, (None, self.shm_in, self.shm_out, None))
+            self.starts += 1
+        return self.shm_in, self.shm_out
+
+    def map(self, key, info, bounds):
+        return self.pool.starmap(run_pooled_tile, [(key, info, top, bottom) for top, bottom in bounds])
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        for shm in (self.shm_in, self.shm_out):
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+        self.shm_in = None
+        self.shm_out = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __repr__(self):
+        return 'TiledPool(%d workers, started %d times)' % (self.workers, self.starts)
+
+
+# splits a filter result into its planes as lists (or bytes) of values
+def result_planes(result):
+    if isinstance(result, CompactImage):
+        return result.planes()
+    if isinstance(result, PlanarImage):
+        return [plane['pixels'] for plane in result.planes]
+    pixels = result['pixels']
+    if pixels and isinstance(pixels[0], tuple):
+        return [plane['pixels'] for plane in split_color(result)]
+    return [pixels]
+
+
+# filters rows top..bottom of the shared input image (plus halo rows, clamped
+# to the image) and writes those rows of the result into the shared output
+# returns whether all the values written were integers
+def run_tile(top, bottom):
+    height, width, channels, out_float, halo, as_dict = TILED_STATE['info']
+    inbuf = TILED_STATE['in'].buf
+    n = height * width
+    lo = max(top - halo, 0)
+    hi = min(bottom + halo, height)
+    data = bytearray().join(inbuf[c*n + lo*width:c*n + hi*width] for c in range(channels))
+    strip = CompactImage(hi - lo, width, data, channels)
+    result = TILED_STATE['filter'](strip.to_dict() if as_dict else strip)
+
+    out = TILED_STATE['out'].buf
+    if out_float:
+        out = out.cast('d')
+    first = (top - lo) * width
+    last = (bottom - lo) * width
+    integers = True
+    for c, plane in enumerate(result_planes(result)):
+        values = plane[first:last]
+        if out_float:
+            if isinstance(values, list):
+                integers = integers and all(isinstance(v, int) for v in values)
+            else:
+                values = list(values)
+            values = array.array('d', values)
+        elif isinstance(values, list):
+            values = bytes(values)
+        out[c*n + top*width:c*n + bottom*width] = values
+    return integers
+
+
+# the planes of a tiled result from the shared output buffer
+def read_planes(shm_out, n, out_channels, out_float, integers):
+    if not out_float:
+        return [bytearray(shm_out.buf[c*n:(c+1)*n]) for c in range(out_channels)]
+    values = shm_out.buf.cast('d')
+    planes = [values[c*n:(c+1)*n].tolist() for c in range(out_channels)]
+    values.release()
+    # a filter that gave ints gets ints back
+    if all(integers):
+        planes = [[int(v) for v in plane] for plane in planes]
+    return planes
+
+
+def tiled_filter(filt, radius=None, workers=None, strips=None, pool=None):
+    """
+    Returns a filter that gives the same result as filt, but runs it on
+    horizontal strips of the image in a pool of worker processes.
+
+    Each strip is filtered together with radius extra rows above and below it
+    (the halo), so pixels next to the cuts see the same neighborhood as in the
+    whole image and the strips stitch together without seams.  The radius is
+    taken from the filter when it is known (blur, sharpen, edges, emboss,
+    cascades of those, ...) and must be given otherwise.
+
+    The image (pixel values 0-255) is copied once into shared memory and the
+    results are written into a shared output buffer, so no pixel lists are
+    pickled.  Needs the fork start method; without it the strips are run one
+    after another in this process.
+
+    By default every call starts its own worker processes and buffers; pass a
+    TiledPool as pool to keep them between calls (for a batch of images).
+    """
+    if radius is None:
+        radius = filter_radius(filt)
+    if radius is None:
+        raise ValueError('radius of the filter is unknown, please pass it')
+    if pool is not None:
+        workers = pool.workers
+        key = len(TILED_FILTERS)
+        TILED_FILTERS[key] = filt
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    def run(image):
+        compact = image if isinstance(image, CompactImage) else CompactImage.from_dict(image)
+        height = compact.height
+        width = compact.width
+        channels = compact.channels
+
+        # run the filter on a small piece first to see how many channels it
+        # gives back.  The results are only stored as bytes if they are known
+        # to be: the filter is marked as clipped or gives back bytes itself.
+        # Anything else (lists of ints that happen to be in range on the
+        # probe, say) goes through a float buffer, since other rows may not be
+        probe_rows = min(height, 2*radius + 1)
+        as_dict = not isinstance(image, CompactImage)
+        probe = CompactImage(probe_rows, width, bytearray().join(
+            plane[:probe_rows*width] for plane in compact.planes()), channels)
+        probe = filt(probe.to_dict() if as_dict else probe)
+        probe_planes = result_planes(probe)
+        out_channels = len(probe_planes)
+        out_bytes = (getattr(filt, 'clip', None) is True or
+                     isinstance(probe_planes[0], (bytes, bytearray, memoryview)))
+        out_float = not out_bytes
+
+        nstrips = strips or workers * 4
+        rows = max(1, -(-height // nstrips))
+        bounds = [(top, min(top + rows, height)) for top in range(0, height, rows)]
+
+        out_size = height * width * out_channels * (8 if out_float else 1)
+        info = (height, width, channels, out_float, radius, as_dict)
+        if pool is not None and pool.context is not None and workers > 1 and len(bounds) > 1:
+            with pool.lock:
+                shm_in, shm_out = pool.buffers(key, len(compact.data), out_size)
+                shm_in.buf[:len(compact.data)] = compact.data
+                integers = pool.map(key, info, bounds)
+                planes = read_planes(shm_out, height * width, out_channels, out_float, integers)
+        else:
+            shm_in = shared_memory.SharedMemory(create=True, size=max(len(compact.data), 1))
+            shm_out = shared_memory.SharedMemory(create=True, size=max(out_size, 1))
+            try:
+                shm_in.buf[:len(compact.data)] = compact.data
+                try:
+                    context = multiprocessing.get_context('fork')
+                except ValueError:
+                    context = None
+                if context is None or workers <= 1 or len(bounds) <= 1:
+                    set_tiled_state(filt, shm_in, shm_out, info)
+                    integers = [run_tile(top, bottom) for top, bottom in bounds]
+                else:
+                    with context.Pool(workers, set_tiled_state, (filt, shm_in, shm_out, info)) as workers_pool:
+                        integers = workers_pool.starmap(run_tile, bounds)
+                planes = read_planes(shm_out, height * width, out_channels, out_float, integers)
+            finally:
+                TILED_STATE.clear()
+                shm_in.close()
+                shm_in.unlink()
+                shm_out.close()
+                shm_out.unlink()
+
+        if out_float:
+            if out_channels == 1:
+                return {'height': height, 'width': width, 'pixels': planes[0]}
+            return combine_color([{'height': height, 'width': width, 'pixels': plane} for plane in planes])
+        result = CompactImage(height, width, bytearray().join(planes), out_channels)
+        if as_dict:
+            return result.to_dict()
+        return result
+
+    run.radius = radius
+    return run
+
+
+# STREAMING
+# images too big to hold as lists of ints are filtered a band of rows at a
+# time.  Rows are kept as bytes, and only band_rows + 2*radius of them are in
+# memory at once, so the memory use is bounded by the width of the image and
+# the reach of the filter, not its height.
+
+# reads rows straight off the disk from a binary (8-bit) PGM or PPM file
+class NetpbmReader:
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        magic = self.file.read(2)
+        if magic not in (b'P5', b'P6'):
+            self.file.close()
+            raise ValueError('%r is not a binary PGM/PPM file' % filename)
+        self.channels = 1 if magic == b'P5' else 3
+        self.width = self.read_number()
+        self.height = self.read_number()
+        if self.read_number() != 255:
+            self.file.close()
+            raise ValueError('only 8-bit PGM/PPM files are supported')
+
+    # reads one header field, skipping whitespace and comments
+    def read_number(self):
+        digits = b''
+        while True:
+            char = self.file.read(1)
+            if char == b'#':
+                self.file.readline()
+            elif char.isdigit():
+                digits += char
+            elif digits or not char:
+                return int(digits)
+
+    # the next count rows, as interleaved bytes
+    def read_rows(self, count):
+        return self.file.read(count * self.width * self.channels)
+
+    def close(self):
+        self.file.close()
+
+
+# reads rows from any other format PIL can open; PIL decodes the whole file,
+# but keeps it as bytes rather than lists of ints
+class PILReader:
+    def __init__(self, filename):
+        img = Image.open(filename)
+        if img.mode.startswith('RGB'):
+            self.img = img.convert('RGB')
+            self.channels = 3
+        elif img.mode == 'LA':
+            self.img = img.getchannel('L')
+            self.channels = 1
+        elif img.mode == 'L':
+            self.img = img
+            self.channels = 1
+        else:
+            raise ValueError('Unsupported image mode: %r' % img.mode)
+        self.width, self.height = img.size
+        self.row = 0
+
+    def read_rows(self, count):
+        count = min(count, self.height - self.row)
+        rows = self.img.crop((0, self.row, self.width, self.row + count)).tobytes()
+        self.row += count
+        return rows
+
+    def close(self):
+        self.img.close()
+
+
+def open_row_reader(filename):
+    with open(filename, 'rb') as f:
+        magic = f.read(2)
+    if magic in (b'P5', b'P6'):
+        return NetpbmReader(filename)
+    return PILReader(filename)
+
+
+# writes rows to a binary PGM/PPM file as they come
+class NetpbmWriter:
+    def __init__(self, filename, width, height, channels):
+        self.file = open(filename, 'wb')
+        self.file.write(b'%s\n%d %d\n255\n' % (b'P5' if channels == 1 else b'P6', width, height))
+
+    def write_rows(self, rows):
+        self.file.write(rows)
+
+    def close(self):
+        self.file.close()
+
+
+# PIL can only encode whole images, so the rows are gathered (as bytes) and
+# saved when the writer is closed
+class PILWriter:
+    def __init__(self, filename, width, height, channels):
+        self.filename = filename
+        self.size = (width, height)
+        self.mode = 'L' if channels == 1 else 'RGB'
+        self.data = bytearray()
+
+    def write_rows(self, rows):
+        self.data += rows
+
+    def close(self):
+        out = Image.frombytes(self.mode, self.size, bytes(self.data))
+        out.save(self.filename)
+        out.close()
+
+
+def open_row_writer(filename, width, height, channels):
+    if filename.lower().endswith(('.pgm', '.ppm', '.pnm')):
+        return NetpbmWriter(filename, width, height, channels)
+    return PILWriter(filename, width, height, channels)
+
+
+# converts interleaved rows read from a file to the channels the filter wants
+# (greyscale uses the same weights as load_image)
+def convert_rows(rows, channels, color):
+    if channels == 3 and not color:
+        return bytes(greyscale_pixels(rows[0::3], rows[1::3], rows[2::3]))
+    if channels == 1 and color:
+        out = bytearray(3 * len(rows))
+        for c in range(3):
+            out[c::3] = rows
+        return out
+    return rows
+
+
+# interleaved rows of bytes -> CompactImage (planar), and back
+def compact_from_rows(rows, width, channels):
+    height = len(rows) // (width * channels)
+    if channels == 1:
+        return CompactImage(height, width, bytearray(rows), 1)
+    return CompactImage(height, width, bytearray().join(rows[c::channels] for c in range(channels)), channels)
+
+
+def rows_from_planes(planes):
+    if len(planes) == 1:
+        return bytes(planes[0])
+    out = bytearray(len(planes[0]) * len(planes))
+    for c, plane in enumerate(planes):
+        out[c::len(planes)] = plane
+    return out
+
+
+# runs filt over the rows of reader, band_rows rows at a time, and yields the
+# filtered bands as CompactImages.  Each band is filtered together with radius
+# rows above and below it, which are dropped from the result again, so the
+# bands are exactly the rows filt would give for the whole image.
+def filtered_bands(reader, filt, radius, band_rows=64, color=False):
+    width = reader.width
+    row_size = width * (3 if color else 1)
+    window = bytearray()
+    window_top = 0
+    read = 0
+    for top in range(0, reader.height, band_rows):
+        bottom = min(top + band_rows, reader.height)
+        hi = min(bottom + radius, reader.height)
+        lo = max(top - radius, 0)
+        window += convert_rows(reader.read_rows(hi - read), reader.channels, color)
+        read = hi
+        del window[:(lo - window_top) * row_size]
+        window_top = lo
+
+        result = filt(compact_from_rows(window, width, 3 if color else 1))
+        first = (top - lo) * width
+        last = (bottom - lo) * width
+        planes = []
+        for plane in result_planes(result):
+            plane = plane[first:last]
+            if not isinstance(plane, (bytes, bytearray, memoryview)):
+                plane = clipped_bytes(plane)
+            planes.append(plane)
+        yield CompactImage(bottom - top, width, bytearray().join(planes), len(planes))
+
+
+def stream_filter(filt, in_filename, out_filename, color=False, band_rows=64, radius=None):
+    """
+    Applies filt to the image in in_filename and saves the result to
+    out_filename without ever loading the whole image as a list of pixels.
+
+    The image is read, filtered and written band_rows rows at a time; the
+    filter sees each band with radius rows of context above and below (taken
+    from the filter when it is known, see filter_radius).  Binary PGM/PPM
+    files are read and written row by row; other formats go through PIL,
+    which holds the encoded side of the image as bytes.  Results are rounded
+    and clipped to [0, 255] like save_image does.
+    """
+    if radius is None:
+        radius = filter_radius(filt)
+    if radius is None:
+        raise ValueError('radius of the filter is unknown, please pass it')
+    reader = open_row_reader(in_filename)
+    writer = None
+    try:
+        for band in filtered_bands(reader, filt, radius, band_rows, color):
+            if writer is None:
+                writer = open_row_writer(out_filename, reader.width, reader.height, band.channels)
+            writer.write_rows(rows_from_planes(band.planes()))
+    finally:
+        reader.close()
+        if writer is not None:
+            writer.close()
+
+
+# BATCH PIPELINE
+# decoding and encoding run on thread pools (PIL releases the GIL while it
+# works) while the filters run on the calling thread, so reading the next
+# images and writing the previous ones overlaps with filtering
+
+# time spent and work done by one stage of the pipeline
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.images = 0
+        self.pixels = 0
+        self.seconds = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, pixels, seconds):
+        with self.lock:
+            self.images += 1
+            self.pixels += pixels
+            self.seconds += seconds
+
+    # images per second of busy time
+    def throughput(self):
+        return self.images / self.seconds if self.seconds else 0.0
+
+    def __repr__(self):
+        return '%s: %d images, %.1f images/s, %.2f Mpixels/s, %.3fs busy' % (
+            self.name, self.images, self.throughput(),
+            self.pixels / self.seconds / 1e6 if self.seconds else 0.0, self.seconds)
+
+
+class PipelineStats:
+    def __init__(self):
+        self.stages = {name: StageStats(name) for name in ('decode', 'filter', 'encode')}
+        self.wall = 0.0
+
+    def __getitem__(self, name):
+        return self.stages[name]
+
+    def __repr__(self):
+        lines = [repr(stage) for stage in self.stages.values()]
+        lines.append('wall: %.3fs' % self.wall)
+        return '\n'.join(lines)
+
+
+# runs func(*args) and records it against stage
+def timed(stage, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    image = result if result is not None else args[0]
+    stage.add(image['height'] * image['width'], time.perf_counter() - start)
+    return result
+
+
+# the files in a directory, in order, or the given paths as they are
+def image_paths(paths):
+    if isinstance(paths, str):
+        return (os.path.join(paths, name) for name in sorted(os.listdir(paths))
+                if os.path.isfile(os.path.join(paths, name)))
+    return iter(paths)
+
+
+def process_images(paths, filters, out_dir, color=False, workers=4, prefetch=8):
+    """
+    Loads every image in paths (a directory or any iterable of file names),
+    applies filters (one filter or a list, which is run as a filter_cascade)
+    and saves the results under the same file names in out_dir.
+
+    Images are decoded up to prefetch ahead of the filter on a pool of
+    workers threads, and encoded and written behind it on another pool.  At
+    most prefetch images wait on either side, so a slow stage holds the others
+    back instead of letting images pile up in memory.  The images are kept as
+    CompactImages all the way through.
+
+    Returns a PipelineStats with the busy time and throughput of each stage.
+    """
+    if isinstance(filters, (list, tuple)):
+        filt = filters[0] if len(filters) == 1 else filter_cascade(list(filters))
+    else:
+        filt = filters
+    load = load_compact_color_image if color else load_compact_image
+    # written without the message save_color_image prints for every image
+    save = functools.partial(write_image, color=color)
+    os.makedirs(out_dir, exist_ok=True)
+
+    stats = PipelineStats()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(workers) as decoders, ThreadPoolExecutor(workers) as encoders:
+        def decode(path):
+            return timed(stats['decode'], load, path)
+
+        def encode(image, path):
+            timed(stats['encode'], save, image, os.path.join(out_dir, os.path.basename(path)))
+
+        paths = image_paths(paths)
+        loading = deque()
+        saving = deque()
+        for path in paths:
+            loading.append((path, decoders.submit(decode, path)))
+            if len(loading) >= prefetch:
+                break
+        while loading:
+            path, future = loading.popleft()
+            for next_path in paths:
+                loading.append((next_path, decoders.submit(decode, next_path)))
+                break
+            result = timed(stats['filter'], filt, future.result())
+
+            saving.append(encoders.submit(encode, result, path))
+            while len(saving) > prefetch:
+                saving.popleft().result()
+        while saving:
+            saving.popleft().result()
+    stats.wall = time.perf_counter() - start
+    return stats
+
+
 # SEAM CARVING
 
 # Main Seam Carving Implementation
 
-def seam_carving(image, ncols):
+def seam_carving(image, ncols, batch=1, energy='sobel', pyramid=0):
     """
     Starting from the given image, use the seam carving technique to remove
     ncols (an integer) columns from the image.
+
+    With batch=k > 1, up to k non-overlapping seams are taken from each
+    cumulative energy map and removed together.  This is much faster but only
+    approximates removing the seams one at a time.
+
+    energy is a name from ENERGY_FUNCTIONS ('sobel', the default, 'l1' or
+    'downsampled'), 'forward', or a function from a greyscale image to its
+    energy.  With pyramid=k, every seam is found on the image shrunk k times
+    by 2 and refined at full size (see pyramid_seam).
     """
-    # create copy of original image
-    im = {'height': image['height'],'width': image['width'],'pixels': []}
-    for x in image['pixels']:
-        im['pixels'].append(x)
+    # removing seams never modifies the image, so only return a copy
+    # when nothing is removed
+    if ncols == 0:
+        return copy_image(image)
+    im = image
+
+    if batch > 1:
+        while ncols > 0:
+            grey = greyscale_image_from_color_image(im)
+            cem = cumulative_energy(grey, energy)
+            seams = minimum_energy_seams(cem, min(batch, ncols))
+            im = image_without_seams(im, seams)
+            ncols -= len(seams)
+        return im
+
+    if pyramid or energy == 'forward' or not hasattr(energy_function(energy), 'magnitude'):
+        for i in range(ncols):
+            grey = greyscale_image_from_color_image(im)
+            if pyramid:
+                seam = pyramid_seam(grey, energy, pyramid)
+            else:
+                seam = find_seam(grey, energy)
+            im = image_without_seam(im, seam)
+        return im
+
+    # greyscale, energy and cumulative energy are kept between seams and only
+    # updated around each removed seam
+    carver = IncrementalCarver(greyscale_image_from_color_image(im), energy_function(energy))
 
     for i in range(ncols):
-        grey = greyscale_image_from_color_image(im)
+        pixels = carver.minimum_energy_seam()
 
-        em = compute_energy(grey)
+        im = image_without_seam(im, pixels)
 
-        cem = cumulative_energy_map(em)
+        carver.remove_seam(pixels)
 
-        pixels = minimum_energy_seam(cem)
+    return im
 
-        im = image_without_seam(im, pixels)
 
+# Incremental seam carving
+# keeps the greyscale image, its energy and the cumulative energy map as lists
+# of rows. after a seam is removed, energy is recomputed only in the band of
+# columns whose 3x3 neighborhood touched the seam, and the cumulative map only
+# in the cone below the changed band; everything else is just shifted over.
+# results (including tie-breaking) are the same as recomputing from scratch
+class IncrementalCarver:
+    def __init__(self, grey, energy=None):
+        if energy is None:
+            energy = compute_energy
+        self.height = grey['height']
+        self.width = grey['width']
+        self.magnitude = energy.magnitude
+        energy = energy(grey)
+        self.grey = list_to_2D(grey)
+        self.energy = list_to_2D(energy)
+        self.cumulative = list_to_2D(cumulative_energy_map(energy))
+
+    # same seam (and same pixel indices) as minimum_energy_seam
+    # on the current cumulative energy map
+    def minimum_energy_seam(self):
+        width = self.width
+        cumulative = self.cumulative
+        btm_row = cumulative[-1]
+        min_index = btm_row.index(min(btm_row))
+
+        rm_pixel = [(self.height-1)*width+min_index]
+        for i in range(self.height - 2, -1, -1):
+            row = cumulative[i]
+            min_val = row[min_index]
+            temp = min_index
+            if min_index != 0 and row[min_index-1] <= min_val:
+                min_val = row[min_index-1]
+                temp = min_index-1
+            if min_index != width-1 and row[min_index+1] < min_val:
+                temp = min_index+1
+            min_index = temp
+            rm_pixel.append(i*width+min_index)
+
+        return rm_pixel
+
+    # remove the seam given as pixel indices (one per row) and update the maps
+    def remove_seam(self, pixels):
+        height = self.height
+        cols = [0]*height
+        for x in pixels:
+            cols[x // self.width] = x % self.width
+        self.width -= 1
+        width = self.width
+
+        for i in range(height):
+            del self.grey[i][cols[i]]
+            del self.energy[i][cols[i]]
+            del self.cumulative[i][cols[i]]
+
+        lo_prev = hi_prev = None
+        for i in range(height):
+            # the Sobel neighborhood of (i, j) changed if any of rows i-1..i+1
+            # lost a pixel within one column of j
+            near = cols[max(i-1, 0):i+2]
+            lo = max(min(near) - 1, 0)
+            hi = min(max(near), width - 1)
+            self.update_energy(i, lo, hi)
+
+            # cumulative values also change below any changed value in row i-1
+            if lo_prev is not None:
+                lo = max(min(lo, lo_prev - 1), 0)
+                hi = min(max(hi, hi_prev + 1), width - 1)
+            self.update_cumulative(i, lo, hi)
+            lo_prev, hi_prev = lo, hi
+
+    # recompute energy (same values as the energy function) for columns
+    # lo..hi of row i
+    def update_energy(self, i, lo, hi):
+        width = self.width
+        magnitude = self.magnitude
+        up = self.grey[max(i-1, 0)]
+        mid = self.grey[i]
+        down = self.grey[min(i+1, self.height-1)]
+        row = self.energy[i]
+        for j in range(lo, hi+1):
+            l = max(j-1, 0)
+            r = min(j+1, width-1)
+            gx = up[r] - up[l] + 2*(mid[r] - mid[l]) + down[r] - down[l]
+            gy = down[l] - up[l] + 2*(down[j] - up[j]) + down[r] - up[r]
+            row[j] = magnitude(gx, gy)
+
+    # recompute cumulative energy for columns lo..hi of row i
+    def update_cumulative(self, i, lo, hi):
+        row = self.cumulative[i]
+        energy = self.energy[i]
+        if i == 0:
+            row[lo:hi+1] = energy[lo:hi+1]
+            return
+        prev = self.cumulative[i-1]
+        last = self.width - 1
+        for j in range(lo, hi+1):
+            min_val = prev[j]
+            if j != 0 and prev[j-1] <= min_val:
+                min_val = prev[j-1]
+            if j != last and prev[j+1] < min_val:
+                min_val = prev[j+1]
+            row[j] = min_val + energy[j]
+
+
+# Seam insertion
+
+def seam_insertion(image, ncols):
+    """
+    Starting from the given image, use seam insertion to add ncols (an
+    integer) columns to the image.
+
+    The lowest-energy non-overlapping seams are all found in one cumulative
+    energy map, and next to every pixel of each seam a new pixel is inserted
+    (the average of that pixel and its right neighbor).  The new image is
+    built in a single pass; when ncols is wider than the image, this is
+    repeated on the widened image.
+    """
+    im = copy_image(image)
+    while ncols > 0:
+        grey = greyscale_image_from_color_image(im)
+        cem = cumulative_energy_map(compute_energy(grey))
+        seams = minimum_energy_seams(cem, min(ncols, im['width']))
+        im = image_with_seams(im, seams)
+        ncols -= len(seams)
     return im
 
 
+# averages two pixels (greyscale values or color tuples)
+def average_pixel(p1, p2):
+    if isinstance(p1, tuple):
+        return tuple(round((a + b) / 2) for a, b in zip(p1, p2))
+    return round((p1 + p2) / 2)
+
+
+# returns a new image with a pixel inserted to the right of every pixel of the
+# given (non-overlapping) seams, built in one pass over the pixels
+def image_with_seams(im, seams):
+    width = im['width']
+    inserted = sorted(x for s in seams for x in s)
+
+    if isinstance(im, CompactImage):
+        data = bytearray()
+        for plane in im.planes():
+            start = 0
+            for x in inserted:
+                right = x + 1 if (x + 1) % width else x
+                data += plane[start:x+1]
+                data.append(average_pixel(plane[x], plane[right]))
+                start = x + 1
+            data += plane[start:]
+        return CompactImage(im.height, width+len(seams), data, im.channels)
+
+    pixels = im['pixels']
+    result = []
+    start = 0
+    for x in inserted:
+        right = x + 1 if (x + 1) % width else x
+        result.extend(pixels[start:x+1])
+        result.append(average_pixel(pixels[x], pixels[right]))
+        start = x + 1
+    result.extend(pixels[start:])
+
+    return {'height': im['height'], 'width': width+len(seams), 'pixels': result}
+
+
+# Row seams and two-dimensional retargeting
+
+# pixels of a transposed image, read straight from the pixels of the base image
+# index k of the view is row k // height, column k % height of the transpose
+class TransposedPixels:
+    def __init__(self, base):
+        self.pixels = base['pixels']
+        self.base_width = base['width']
+        self.base_height = base['height']
+
+    def __len__(self):
+        return self.base_width * self.base_height
+
+    # one row of the view is one (strided) column of the base image
+    def row(self, i, start=0, stop=None):
+        if stop is None:
+            stop = self.base_height
+        w = self.base_width
+        return self.pixels[start*w + i:stop*w + i:w]
+
+    def __getitem__(self, key):
+        h = self.base_height
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return [self[k] for k in range(start, stop, step)]
+            result = []
+            while start < stop:
+                i, j = divmod(start, h)
+                end = min(stop, (i+1)*h)
+                result.extend(self.row(i, j, end - i*h))
+                start = end
+            return result
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError('pixel index out of range')
+        i, j = divmod(key, h)
+        return self.pixels[j*self.base_width + i]
+
+    def __iter__(self):
+        for i in range(self.base_width):
+            yield from self.row(i)
+
+
+# transposed view of a dictionary image, sharing the pixels of the original
+# (rows of the view are the columns of the image)
+class TransposedImage:
+    def __init__(self, image):
+        self.base = image
+        self.height = image['width']
+        self.width = image['height']
+
+    def keys(self):
+        return ('height', 'width', 'pixels')
+
+    def __getitem__(self, key):
+        if key == 'height':
+            return self.height
+        if key == 'width':
+            return self.width
+        if key == 'pixels':
+            return TransposedPixels(self.base)
+        raise KeyError(key)
+
+
+# returns the transpose of an image without copying the pixels
+# (CompactImages are transposed with a strided copy of each plane instead)
+def transposed(image):
+    if isinstance(image, TransposedImage):
+        return image.base
+    if isinstance(image, CompactImage):
+        w = image.width
+        data = bytearray().join(bytes(plane[i::w]) for plane in image.planes() for i in range(w))
+        return CompactImage(image.width, image.height, data, image.channels)
+    return TransposedImage(image)
+
+
+# like transposed, but always returns a new image (never a view)
+def transpose_image(image):
+    if isinstance(image, TransposedImage):
+        return copy_image(image.base)
+    view = transposed(image)
+    if isinstance(view, CompactImage):
+        return view
+    return copy_image(view)
+
+
+# returns a copy of an image (or of a view of one)
+def copy_image(image):
+    if isinstance(image, CompactImage):
+        return image.copy()
+    return {'height': image['height'], 'width': image['width'], 'pixels': list(image['pixels'])}
+
+
+# removes nrows horizontal seams by carving columns of the transposed image
+def seam_carving_rows(image, nrows, batch=1):
+    return transpose_image(seam_carving(transposed(image), nrows, batch))
+
+
+# returns (cost, image) for the image with its lowest-energy column seam removed
+# cost is the total energy along the seam (the bottom-row minimum of the
+# cumulative energy map)
+def carve_one_seam(image):
+    grey = greyscale_image_from_color_image(image)
+    cost, seam = minimum_seam(compute_energy(grey))
+    return cost, image_without_seam(image, seam)
+
+
+def retarget(image, new_width, new_height):
+    """
+    Shrink the image to new_width x new_height by removing both column and row
+    seams, choosing the order of removals with the optimal-order dynamic
+    program: T(r, c) = min(T(r-1, c) + cost of the best row seam,
+                           T(r, c-1) + cost of the best column seam)
+
+    Only the images of the previous row of the table are kept.  Every image is
+    stored either as is or transposed (whichever the seam removal produced),
+    so switching direction never copies pixels to transpose them.
+    """
+    nrows = image['height'] - new_height
+    ncols = image['width'] - new_width
+    if nrows < 0 or ncols < 0:
+        raise ValueError('retarget can only make images smaller')
+
+    # entries are (total cost, stored image, stored image is transposed)
+    prev = None
+    for r in range(nrows + 1):
+        cur = []
+        for c in range(ncols + 1):
+            if r == 0 and c == 0:
+                cur.append((0, image, False))
+                continue
+            options = []
+            if c > 0:
+                cost, im, flipped = cur[c-1]
+                work = transposed(im) if flipped else im
+                seam_cost, result = carve_one_seam(work)
+                options.append((cost + seam_cost, result, False))
+            if r > 0:
+                cost, im, flipped = prev[c]
+                work = im if flipped else transposed(im)
+                seam_cost, result = carve_one_seam(work)
+                options.append((cost + seam_cost, result, True))
+            # ties go to the column seam
+            best = options[0]
+            for option in options[1:]:
+                if option[0] < best[0]:
+                    best = option
+            cur.append(best)
+        prev = cur
+
+    cost, result, flipped = prev[ncols]
+    if flipped:
+        return transpose_image(result)
+    if result is image:
+        return copy_image(image)
+    return result
+
+
 # Optional Helper Functions for Seam Carving
 
 # convert color image to greyscale using formula
@@ -365,10 +2376,32 @@ def greyscale_image_from_color_image(image):
 
     Returns a greyscale image (represented as a dictionary).
     """
-    def greyscale(colors):
-        color = round(.299*colors[0]+.587*colors[1]+.114*colors[2])
-        return color
-    return apply_per_pixel(image, greyscale)
+    if isinstance(image, PlanarImage):
+        return {'height': image.height, 'width': image.width,
+                'pixels': greyscale_pixels(*[plane['pixels'] for plane in image.planes])}
+    if isinstance(image, CompactImage):
+        if image.channels == 1:
+            return image.copy()
+        return CompactImage(image.height, image.width, bytearray(greyscale_pixels(*image.planes())))
+
+    # splitting the tuples into planes costs more than the tables save
+    return {'height': image['height'], 'width': image['width'],
+            'pixels': [round(.299*rv+.587*gv+.114*bv) for rv, gv, bv in image['pixels']]}
+
+
+# .299*r, .587*g and .114*b for every 8-bit value
+GREY_TABLES = tuple([weight * v for v in range(256)] for weight in (.299, .587, .114))
+
+
+# round(.299*r + .587*g + .114*b) for each pixel of the r, g, b planes
+# the products are looked up rather than computed, which gives the same floats
+def greyscale_pixels(r, g, b):
+    try:
+        r, g, b = bytes(r), bytes(g), bytes(b)
+    except (TypeError, ValueError):
+        return [round(.299*rv+.587*gv+.114*bv) for rv, gv, bv in zip(r, g, b)]
+    tr, tg, tb = GREY_TABLES
+    return [round(tr[rv]+tg[gv]+tb[bv]) for rv, gv, bv in zip(r, g, b)]
 
 
 # use edges function to compute energy
@@ -381,6 +2414,232 @@ def compute_energy(grey):
     """
     return edges(grey)
 
+
+# ENERGY FUNCTIONS
+# carving only compares energies, so cheaper measures than the rounded and
+# clipped Sobel magnitude of compute_energy work nearly as well.  Energies
+# built from the 3x3 Sobel gradients carry .magnitude(gx, gy), the value of
+# one pixel, which lets IncrementalCarver and the pyramid search recompute
+# single pixels; others are recomputed over the whole image.
+
+def sobel_magnitude(gx, gy):
+    return min(round(math.sqrt(gx*gx + gy*gy)), 255)
+
+
+def l1_magnitude(gx, gy):
+    return abs(gx) + abs(gy)
+
+
+compute_energy.magnitude = sobel_magnitude
+
+
+# |gx| + |gy| of the Sobel gradients: no square root, rounding or clipping
+def energy_l1(grey):
+    height = grey['height']
+    width = grey['width']
+    rows = padded_rows(grey, 1)
+
+    result = []
+    for i in range(height):
+        up = rows[max(i-1, 0)]
+        mid = rows[i]
+        down = rows[min(i+1, height-1)]
+        for a, b, c, d, f, g, h, k in zip(up, up[1:], up[2:], mid, mid[2:], down, down[1:], down[2:]):
+            gx = c - a + 2*(f - d) + k - g
+            gy = g - a + 2*(h - b) + k - c
+            result.append((gx if gx > 0 else -gx) + (gy if gy > 0 else -gy))
+    return {'height': height, 'width': width, 'pixels': result}
+
+
+energy_l1.magnitude = l1_magnitude
+
+
+# energy of the image shrunk by factor (see area_downsample), scaled back up
+# by repeating each value over the factor x factor block it came from
+def downsampled_energy(grey, factor=2, energy=None):
+    if energy is None:
+        energy = compute_energy
+    small = energy(area_downsample(grey, factor))
+    height = grey['height']
+    width = grey['width']
+    pixels = small['pixels']
+    sw = small['width']
+    cols = [j // factor for j in range(width)]
+    result = []
+    for i in range(height):
+        row = pixels[(i // factor)*sw:(i // factor + 1)*sw]
+        result.extend([row[j] for j in cols])
+    return {'height': height, 'width': width, 'pixels': result}
+
+
+# shrinks a greyscale image by factor in both directions; each pixel is the
+# rounded average of its factor x factor block (blocks at the right and
+# bottom edges may be smaller)
+def area_downsample(image, factor=2):
+    height = image['height']
+    width = image['width']
+    pixels = image['pixels']
+    new_height = -(-height // factor)
+    new_width = -(-width // factor)
+    result = []
+    for i in range(new_height):
+        block = [pixels[r*width:(r+1)*width] for r in range(i*factor, min((i+1)*factor, height))]
+        col_sums = [sum(column) for column in zip(*block)]
+        for j in range(0, width, factor):
+            part = col_sums[j:j+factor]
+            result.append(round(sum(part) / (len(block)*len(part))))
+    if isinstance(image, CompactImage):
+        return CompactImage(new_height, new_width, bytearray(result))
+    return {'height': new_height, 'width': new_width, 'pixels': result}
+
+
+# energies that seam_carving accepts by name ('forward' is handled apart,
+# since its cost depends on the step the seam takes, not just on the pixel)
+ENERGY_FUNCTIONS = {
+    'sobel': compute_energy,
+    'l1': energy_l1,
+    'downsampled': downsampled_energy,
+}
+
+
+# the energy function for a name in ENERGY_FUNCTIONS, or energy itself if it
+# is already a function of a greyscale image
+def energy_function(energy):
+    if callable(energy):
+        return energy
+    if energy not in ENERGY_FUNCTIONS:
+        raise ValueError('Unknown energy: %r' % (energy,))
+    return ENERGY_FUNCTIONS[energy]
+
+
+# forward energy (Rubinstein, Shamir and Avidan): instead of the energy of the
+# removed pixels, a seam costs the new edges its removal creates between
+# pixels that become neighbors.  Returns the cumulative cost map and, for
+# every pixel, which pixel above it the cheapest seam came from (as a column
+# offset of -1, 0 or 1 in an int8 array, see minimum_seam)
+def forward_cumulative_map(grey):
+    height = grey['height']
+    width = grey['width']
+    rows = padded_rows(grey, 1)
+
+    cumulative = []
+    back = array.array('b', bytes(width))
+    prev = None
+    for i in range(height):
+        row = rows[i]
+        up = rows[max(i-1, 0)]
+        cur = []
+        if prev is None:
+            # row is padded by one, so row[j] is column j-1 and row[j+2] column j+1
+            cumulative.append([abs(row[j+2] - row[j]) for j in range(width)])
+            prev = cumulative[-1]
+            continue
+        steps = []
+        for j in range(width):
+            left = row[j]
+            right = row[j+2]
+            above = up[j+1]
+            cost_up = abs(right - left)
+            best = prev[j] + cost_up
+            step = 0
+            if j != 0:
+                cost = prev[j-1] + cost_up + abs(above - left)
+                if cost <= best:
+                    best = cost
+                    step = -1
+            if j != width-1:
+                cost = prev[j+1] + cost_up + abs(above - right)
+                if cost < best:
+                    best = cost
+                    step = 1
+            cur.append(best)
+            steps.append(step)
+        cumulative.append(cur)
+        back.extend(steps)
+        prev = cur
+
+    cem = {'height': height, 'width': width, 'pixels': [v for row in cumulative for v in row]}
+    return cem, back
+
+
+# the minimum forward-energy seam, as pixel indices from the bottom row up
+def forward_energy_seam(grey):
+    cem, back = forward_cumulative_map(grey)
+    width = cem['width']
+    return trace_seam(back, width, cem['pixels'][-width:])[1]
+
+
+# Compact seam search
+# the cumulative energy map is only needed one row at a time: each row only
+# depends on the row above it.  minimum_seam keeps just that row, and for
+# every pixel the step (-1, 0 or 1 column) to the pixel above it that the
+# cumulative value came from, one signed byte per pixel.  The seam is then
+# traced back through those steps without looking at any energies again.
+# The steps follow the tie rules of cumulative_energy_map and
+# minimum_energy_seam (center first, then left if <=, then right if <), so
+# the seam is the same as minimum_energy_seam(cumulative_energy_map(energy)).
+
+# returns (total energy of the seam, seam as pixel indices from the bottom row up)
+def minimum_seam(energy):
+    height = energy['height']
+    width = energy['width']
+    pixels = energy['pixels']
+    inf = float('inf')
+
+    prev = list(pixels[:width])
+    back = array.array('b', bytes(width))
+    for i in range(1, height):
+        left = [inf] + prev[:-1]
+        right = prev[1:] + [inf]
+        cur = []
+        steps = []
+        for l, c, r, e in zip(left, prev, right, pixels[i*width:(i+1)*width]):
+            if l <= c:
+                if r < l:
+                    cur.append(r + e)
+                    steps.append(1)
+                else:
+                    cur.append(l + e)
+                    steps.append(-1)
+            elif r < c:
+                cur.append(r + e)
+                steps.append(1)
+            else:
+                cur.append(c + e)
+                steps.append(0)
+        back.extend(steps)
+        prev = cur
+
+    return trace_seam(back, width, prev)
+
+
+# follows the steps in back up from the lowest (leftmost on ties) value of the
+# bottom row; returns (that value, seam as pixel indices from the bottom up)
+def trace_seam(back, width, btm_row):
+    cost = min(btm_row)
+    col = btm_row.index(cost)
+    index = len(back) - width + col
+    seam = [index]
+    while index >= width:
+        index += back[index] - width
+        seam.append(index)
+    return cost, seam
+
+
+# cumulative energy map of a greyscale image for any energy
+def cumulative_energy(grey, energy='sobel'):
+    if energy == 'forward':
+        return forward_cumulative_map(grey)[0]
+    return cumulative_energy_map(energy_function(energy)(grey))
+
+
+# the minimum-energy seam of a greyscale image for any energy
+def find_seam(grey, energy='sobel'):
+    if energy == 'forward':
+        return forward_energy_seam(grey)
+    return minimum_seam(energy_function(energy)(grey))[1]
+
+
 #
 def cumulative_energy_map(energy):
     """
@@ -469,6 +2728,127 @@ def minimum_energy_seam(c):
 
     return rm_pixel
 
+# finds up to k seams in one cumulative energy map that share no pixels
+# seams are started from the lowest bottom-row values and traced upwards like
+# minimum_energy_seam, but only through pixels no earlier seam has used;
+# a seam that runs into used pixels on all sides is dropped
+def minimum_energy_seams(c, k):
+    height = c['height']
+    width = c['width']
+    new = list_to_2D(c)
+
+    used = [set() for i in range(height)]
+    seams = []
+    for start in sorted(range(width), key=lambda x: (new[height-1][x], x)):
+        if len(seams) == k:
+            break
+        min_index = start
+        cols = [start]
+        for i in range(height - 2, -1, -1):
+            row = new[i]
+            temp = None
+            for j in (min_index, min_index-1, min_index+1):
+                if 0 <= j < width and j not in used[i]:
+                    # ties prefer the center, then the left neighbor
+                    if temp is None or row[j] < row[temp] or (row[j] == row[temp] and j == min_index-1):
+                        temp = j
+            if temp is None:
+                break
+            min_index = temp
+            cols.append(min_index)
+        else:
+            seam = []
+            for i, col in zip(range(height - 1, -1, -1), cols):
+                used[i].add(col)
+                seam.append(i*width+col)
+            seams.append(seam)
+
+    return seams
+
+
+# Pyramid seam search
+# the seam is found on the image shrunk by 2 (recursively, levels times), then
+# refined at full size by searching only the pixels within band columns of
+# the coarse seam.  Energy is only computed for those pixels when the energy
+# has a .magnitude; otherwise it is computed for the whole image.
+
+def pyramid_seam(grey, energy='sobel', levels=1, band=2):
+    if energy == 'forward':
+        raise ValueError('forward energy cannot be searched on a pyramid')
+    if levels <= 0 or grey['height'] < 2 or grey['width'] < 2:
+        return find_seam(grey, energy)
+    coarse = area_downsample(grey, 2)
+    coarse_seam = pyramid_seam(coarse, energy, levels - 1, band)
+    cw = coarse['width']
+    coarse_cols = [0]*coarse['height']
+    for x in coarse_seam:
+        coarse_cols[x // cw] = x % cw
+    centers = [min(2*coarse_cols[i // 2], grey['width'] - 1) for i in range(grey['height'])]
+    return refined_seam(grey, energy_function(energy), centers, max(band, 1))
+
+
+# minimum-energy seam among the pixels within band columns of centers (one
+# column per row), with the same tie-breaking as minimum_energy_seam
+def refined_seam(grey, energy, centers, band):
+    height = grey['height']
+    width = grey['width']
+    windows = [range(max(c - band, 0), min(c + band, width - 1) + 1) for c in centers]
+
+    magnitude = getattr(energy, 'magnitude', None)
+    if magnitude is None:
+        full = energy(grey)['pixels']
+
+        def pixel_energy(i, j):
+            return full[i*width + j]
+    else:
+        pixels = grey['pixels']
+
+        def pixel_energy(i, j):
+            up = max(i-1, 0)*width
+            mid = i*width
+            down = min(i+1, height-1)*width
+            l = max(j-1, 0)
+            r = min(j+1, width-1)
+            gx = pixels[up+r] - pixels[up+l] + 2*(pixels[mid+r] - pixels[mid+l]) + pixels[down+r] - pixels[down+l]
+            gy = pixels[down+l] - pixels[up+l] + 2*(pixels[down+j] - pixels[up+j]) + pixels[down+r] - pixels[up+r]
+            return magnitude(gx, gy)
+
+    # cumulative energy of the pixels in each window (None if unreachable)
+    cumulative = []
+    prev = None
+    for i in range(height):
+        cur = {}
+        for j in windows[i]:
+            if prev is None:
+                cur[j] = pixel_energy(i, j)
+                continue
+            best = prev.get(j)
+            left = prev.get(j-1)
+            if left is not None and (best is None or left <= best):
+                best = left
+            right = prev.get(j+1)
+            if right is not None and (best is None or right < best):
+                best = right
+            if best is not None:
+                cur[j] = best + pixel_energy(i, j)
+        cumulative.append(cur)
+        prev = cur
+
+    btm_row = cumulative[-1]
+    col = min(btm_row, key=lambda j: (btm_row[j], j))
+    seam = [(height-1)*width + col]
+    for i in range(height - 2, -1, -1):
+        row = cumulative[i]
+        best = col if col in row else None
+        if col - 1 in row and (best is None or row[col-1] <= row[best]):
+            best = col - 1
+        if col + 1 in row and (best is None or row[col+1] < row[best]):
+            best = col + 1
+        col = best
+        seam.append(i*width + col)
+    return seam
+
+
 # HELPER FUNCTION - convert list to 2D array
 def list_to_2D(image):
     pixels = image['pixels']
@@ -491,11 +2871,34 @@ def image_without_seam(im, s):
     pixels from the original image except those corresponding to the locations
     in the given list.
     """
+    return image_without_seams(im, [s])
+
+
+# removes several seams (each a list of pixel indices, one per row) at once
+# the seams must not share pixels; the pixels are compacted in a single pass
+def image_without_seams(im, seams):
+    removed = sorted(x for s in seams for x in s)
+
+    if isinstance(im, CompactImage):
+        # copy the runs of each plane between removed indices
+        data = bytearray()
+        for plane in im.planes():
+            start = 0
+            for x in removed:
+                data += plane[start:x]
+                start = x + 1
+            data += plane[start:]
+        return CompactImage(im.height, im.width-len(seams), data, im.channels)
+
     pixels = im['pixels']
-    for x in s:
-        del pixels[x]
+    kept = []
+    start = 0
+    for x in removed:
+        kept.extend(pixels[start:x])
+        start = x + 1
+    kept.extend(pixels[start:])
 
-    return {'height': im['height'], 'width': im['width']-1, 'pixels': pixels}
+    return {'height': im['height'], 'width': im['width']-len(seams), 'pixels': kept}
 
 
 def emboss(image, n, direction = 'horizontal'):
@@ -507,6 +2910,22 @@ def emboss(image, n, direction = 'horizontal'):
     #emboss_kernel = [[1, 0, 0, 0, 0],[0, 1, 0, 0, 0],[0, 0, 0, 0, 0],[0, 0, 0, -1, 0],[0, 0, 0, 0, -1]]
     #emboss_kernel = [[0, 0, +1, 0, 0],[0, 0, 0, 0, 0],[0, 0, 0, 0, 0],[0, 0, 0, 0, 0],[0, 0, -1, 0, 0]]
 
+    kernel = emboss_kernel(n, direction)
+
+    result = correlate(grey, kernel)
+
+    for i in range(len(result['pixels'])):
+        result['pixels'][i] += 128
+
+    # never clipped, whatever the input (a CompactImage gives a dictionary),
+    # so make_emboss_filter can be fused with the filters after it
+    return result
+
+
+# nxn emboss kernel: 1 and -1 at opposite edges, in the given direction
+# (built once per size and direction and shared, like blurred_kernel)
+@functools.lru_cache(maxsize=FACTORY_CACHE_SIZE)
+def emboss_kernel(n, direction='horizontal'):
     #create nxn array of 0s
     kernel = [[0 for i in range(n)] for j in range(n)]
     if direction == 'vertical':
@@ -515,13 +2934,7 @@ def emboss(image, n, direction = 'horizontal'):
     else:
         kernel[int(n/2)][0] = 1
         kernel[int(n/2)][n-1] = -1
-
-    result = correlate(grey, kernel)
-
-    for i in range(len(result['pixels'])):
-        result['pixels'][i] += 128
-
-    return result
+    return tuple(tuple(row) for row in kernel)
 
 
 def blue_highlight(image):
@@ -536,6 +2949,10 @@ def blue_highlight(image):
     return {'height': image['height'],'width': image['width'], 'pixels': pix}
 
 def threshold(image, t=200):
+    return apply_per_pixel(image, threshold_point(t))
+
+
+def threshold_point(t):
 
     def threshold1(color):
         if color >= t:
@@ -543,7 +2960,142 @@ def threshold(image, t=200):
         else:
             return 0
 
-    return apply_per_pixel(image, threshold1)
+    return threshold1
+
+threshold.radius = 0
+threshold.point = threshold_point(200)
+
+
+# IMAGE PYRAMID
+
+# shrinks a greyscale or color image (dictionary or CompactImage) by factor,
+# averaging each channel with area_downsample
+def downsample_image(image, factor=2):
+    if isinstance(image, CompactImage):
+        if image.channels == 1:
+            return area_downsample(image, factor)
+        planes = [area_downsample(image.channel_image(c), factor) for c in range(image.channels)]
+        return CompactImage(planes[0].height, planes[0].width,
+                            bytearray().join(plane.data for plane in planes), image.channels)
+    pixels = image['pixels']
+    if pixels and isinstance(pixels[0], tuple):
+        return combine_color([area_downsample(plane, factor) for plane in split_color(image)])
+    return area_downsample(image, factor)
+
+
+# odd blur size at a level shrunk by scale that covers about the same area as
+# a blur of size n at full size
+def level_blur_size(n, scale):
+    return max(1, 2 * round((n / scale - 1) / 2) + 1)
+
+
+class ImagePyramid:
+    """
+    The same image at several resolutions, for previews at different zoom
+    levels.  Level 0 is the image itself and each level after it is the one
+    before shrunk by factor (see downsample_image), down to a single pixel.
+    Levels are built the first time they are asked for, and filter results
+    are kept per level, so going back to a zoom level that was shown before
+    costs a lookup.  Results are copied in and out; only use pure filters.
+
+        invert = color_filter_from_greyscale_filter(inverted)
+        pyramid = ImagePyramid(load_color_image('test_images/cat.png'))
+        pyramid.apply(invert, 2)        # runs on level 2 only
+        pyramid.apply(invert, 2)        # from the cache
+        pyramid.blurred(9, 2)           # blurred(image, 9) as seen at level 2
+        pyramid.preview(invert, 100)    # on the smallest level >= 100 wide
+    """
+    def __init__(self, image, factor=2):
+        if factor < 2:
+            raise ValueError('factor must be at least 2, got %r' % (factor,))
+        self.factor = factor
+        self.levels = [image]
+        self.results = [{}]
+        self.color_filters = {}
+        if isinstance(image, CompactImage):
+            self.color = image.channels > 1
+        else:
+            self.color = bool(image['pixels']) and isinstance(image['pixels'][0], tuple)
+        self.hits = 0
+        self.misses = 0
+        height = image['height']
+        width = image['width']
+        self.depth = 1
+        while height > 1 or width > 1:
+            height = -(-height // factor)
+            width = -(-width // factor)
+            self.depth += 1
+
+    # the image at level k, building it (and the levels above it) if needed
+    def level(self, k):
+        if not 0 <= k < self.depth:
+            raise IndexError('level %r out of range (pyramid has %d levels)' % (k, self.depth))
+        while len(self.levels) <= k:
+            self.levels.append(downsample_image(self.levels[-1], self.factor))
+            self.results.append({})
+        return self.levels[k]
+
+    # (height, width) of level k, without building it
+    def level_size(self, k):
+        height = self.levels[0]['height']
+        width = self.levels[0]['width']
+        for _ in range(k):
+            height = -(-height // self.factor)
+            width = -(-width // self.factor)
+        return height, width
+
+    # the smallest level that is still at least width pixels wide (level 0
+    # if the image itself is narrower)
+    def level_for(self, width):
+        k = 0
+        while k + 1 < self.depth and self.level_size(k + 1)[1] >= width:
+            k += 1
+        return k
+
+    # filt(level k, *params), computed once per level
+    def apply(self, filt, k=0, *params):
+        image = self.level(k)
+        key = (filt, params)
+        results = self.results[k]
+        if key in results:
+            self.hits += 1
+            return copy_result(results[key])
+        self.misses += 1
+        result = filt(image, *params)
+        results[key] = copy_result(result)
+        return result
+
+    # filt on the level to show at width pixels wide
+    def preview(self, filt, width, *params):
+        return self.apply(filt, self.level_for(width), *params)
+
+    # a box blur of size n at full size, seen at level k: the blur is run on
+    # level k with its size scaled down to match
+    def blurred(self, n, k=0, clip=True):
+        filt = make_blur_filter(level_blur_size(n, self.factor ** k), clip)
+        if self.color:
+            if filt not in self.color_filters:
+                self.color_filters[filt] = color_filter_from_greyscale_filter(filt)
+            filt = self.color_filters[filt]
+        return self.apply(filt, k)
+
+    # drops the cached results (levels that were built are kept)
+    def clear(self):
+        self.results = [{} for _ in self.levels]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'levels': self.depth, 'built': len(self.levels),
+                'results': sum(len(results) for results in self.results),
+                'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def __len__(self):
+        return self.depth
+
+    def __repr__(self):
+        return 'ImagePyramid(%dx%d, %d levels, %d built)' % (
+            self.levels[0]['height'], self.levels[0]['width'], self.depth, len(self.levels))
 
 
 # HELPER FUNCTIONS FOR LOADING AND SAVING COLOR IMAGES
@@ -565,6 +3117,16 @@ def load_color_image(filename):
         return {'height': h, 'width': w, 'pixels': pixels}
 
 
+# same as load_color_image, but returns a planar CompactImage
+def load_compact_color_image(filename):
+    with open(filename, 'rb') as img_handle:
+        img = Image.open(img_handle)
+        img = img.convert('RGB')
+        data = bytearray().join(band.tobytes() for band in img.split())
+        w, h = img.size
+        return CompactImage(h, w, data, 3)
+
+
 def save_color_image(image, filename, mode='PNG'):
     """
     Saves the given color image to disk or to a file-like object.  If filename
@@ -572,13 +3134,7 @@ def save_color_image(image, filename, mode='PNG'):
     If filename is given as a file-like object, the file type will be
     determined by the 'mode' parameter.
     """
-    out = Image.new(mode='RGB', size=(image['width'], image['height']))
-    out.putdata(image['pixels'])
-    if isinstance(filename, str):
-        out.save(filename)
-    else:
-        out.save(filename, mode)
-    out.close()
+    write_image(image, filename, mode, color=True)
     print('DONE')
 
 
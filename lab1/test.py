@@ -4,7 +4,11 @@ import os
 import lab
 import pickle
 import hashlib
+import tempfile
 import unittest
+import io
+import functools
+import contextlib
 import collections
 
 TEST_DIRECTORY = os.path.dirname(__file__)
@@ -178,6 +182,12 @@ class TestColorFilters(Lab1Test):
                     self.assertEqual(object_hash(im), oim, 'Be careful not to modify the original image!')
                     self.compare_color_images(result, expected)
 
+    def test_color_filter_from_partial(self):
+        im = {'height': 4, 'width': 5, 'pixels': [((7*i) % 256, (31*i) % 256, (90 + i) % 256) for i in range(20)]}
+        blur = lab.color_filter_from_greyscale_filter(functools.partial(lab.blurred, n=3))
+        self.assertIn('partial', blur.name)
+        self.compare_color_images(blur(im), lab.color_filter_from_greyscale_filter(lab.make_blur_filter(3))(im))
+
 
 class TestCascade(Lab1Test):
     def setUp(self):
@@ -340,6 +350,590 @@ class TestSeamCarving(Lab1Test):
             self.compare_color_images(result, lab.load_color_image(expfile))
 
 
+class TestCompactImage(Lab1Test):
+    def setUp(self):
+        self.im = {'height': 4, 'width': 5,
+                   'pixels': [((13*i) % 256, (29*i*i) % 256, (255 - 7*i) % 256) for i in range(20)]}
+
+    def test_round_trip(self):
+        compact = lab.CompactImage.from_dict(self.im)
+        self.assertEqual(compact.channels, 3)
+        self.compare_color_images(compact.to_dict(), self.im)
+
+    def test_color_filters_match_dictionary_form(self):
+        compact = lab.CompactImage.from_dict(self.im)
+        oim = object_hash(self.im)
+        for filt in (lab.inverted, lab.edges, lab.make_blur_filter(3)):
+            color_filter = lab.color_filter_from_greyscale_filter(filt)
+            result = color_filter(compact)
+            self.assertIsInstance(result, lab.CompactImage)
+            self.compare_color_images(result.to_dict(), color_filter(self.im))
+        self.assertEqual(object_hash(self.im), oim, 'Be careful not to modify the original image!')
+
+    def test_unclipped_color_filters(self):
+        compact = lab.CompactImage.from_dict(self.im)
+        kernel = [[0, -1, 0], [-1, 5, -1], [0, -1, 0]]
+        for filt in (lab.make_blur_filter(3, clip=False), lambda im: lab.correlate(im, kernel)):
+            color_filter = lab.color_filter_from_greyscale_filter(filt)
+            self.assertEqual(color_filter(compact), color_filter(self.im))
+
+    def test_seam_carving_matches_dictionary_form(self):
+        compact = lab.CompactImage.from_dict(self.im)
+        self.compare_color_images(lab.seam_carving(compact, 2).to_dict(), lab.seam_carving(self.im, 2))
+
+
+class TestCorrelationBackends(Lab1Test):
+    def test_backends_match_per_pixel_correlation(self):
+        im = {'height': 6, 'width': 7, 'pixels': [(53*i + 11) % 256 for i in range(42)]}
+        kernels = ([[0, 1, 0], [2, -3, 1], [0, 0, 4]],
+                   [[1, 0, 0, 0, -1]],
+                   lab.blurred_kernel(5))
+        for kernel in kernels:
+            expected = [lab.multiply_array(lab.get_subarray(im, x, y, kernel), kernel)
+                        for x in range(im['height']) for y in range(im['width'])]
+            for backend in lab.CORRELATION_BACKENDS:
+                with self.subTest(backend=backend, kernel=kernel):
+                    self.assertEqual(lab.correlate(im, kernel, backend)['pixels'], expected)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            lab.set_correlation_backend('no-such-backend')
+
+    def test_edges_of_float_image(self):
+        im = {'height': 10, 'width': 10, 'pixels': [(37*i*i + 19*i) % 256 for i in range(100)]}
+        blurred = lab.blurred(im, 3, clip=False)
+        backend = lab.correlation_backend
+        try:
+            lab.set_correlation_backend('python')
+            expected = lab.edges(blurred)
+            for backend_name in lab.CORRELATION_BACKENDS:
+                lab.set_correlation_backend(backend_name)
+                with self.subTest(backend=backend_name):
+                    self.assertEqual(lab.edges(blurred), expected)
+                    cascade = lab.filter_cascade([lab.make_blur_filter(3, clip=False), lab.edges])
+                    self.assertEqual(cascade(im), expected)
+        finally:
+            lab.set_correlation_backend(backend)
+
+
+class TestIncrementalCarving(Lab1Test):
+    def test_matches_full_recomputation(self):
+        im = {'height': 8, 'width': 10,
+              'pixels': [((7*i) % 3 * 60, (i*i) % 5 * 40, (3*i) % 7 * 30) for i in range(80)]}
+        oim = object_hash(im)
+        expected = {'height': 8, 'width': 10, 'pixels': im['pixels'][:]}
+        for ncols in range(1, 7):
+            grey = lab.greyscale_image_from_color_image(expected)
+            cem = lab.cumulative_energy_map(lab.compute_energy(grey))
+            expected = lab.image_without_seam(expected, lab.minimum_energy_seam(cem))
+            with self.subTest(ncols=ncols):
+                self.compare_color_images(lab.seam_carving(im, ncols), expected)
+        self.assertEqual(object_hash(im), oim, 'Be careful not to modify the original image!')
+
+
+class TestBatchCarving(Lab1Test):
+    def setUp(self):
+        self.im = {'height': 6, 'width': 9,
+                   'pixels': [((11*i) % 256, (5*i*i) % 256, (200 - 3*i) % 256) for i in range(54)]}
+
+    def test_seams_do_not_overlap(self):
+        grey = lab.greyscale_image_from_color_image(self.im)
+        cem = lab.cumulative_energy_map(lab.compute_energy(grey))
+        seams = lab.minimum_energy_seams(cem, 4)
+        self.assertEqual(len(seams), 4)
+        self.assertEqual(set(seams[0]), set(lab.minimum_energy_seam(cem)))
+        pixels = [x for seam in seams for x in seam]
+        self.assertEqual(len(pixels), len(set(pixels)))
+        for seam in seams:
+            self.assertEqual(sorted(x // 9 for x in seam), list(range(6)))
+
+    def test_batch_removes_requested_columns(self):
+        oim = object_hash(self.im)
+        for ncols in (1, 4, 7):
+            result = lab.seam_carving(self.im, ncols, batch=3)
+            self.assertEqual(result['width'], 9 - ncols)
+            self.assertEqual(len(result['pixels']), 6*(9 - ncols))
+        self.assertEqual(object_hash(self.im), oim, 'Be careful not to modify the original image!')
+
+
+class TestRetarget(Lab1Test):
+    def setUp(self):
+        self.im = {'height': 5, 'width': 7,
+                   'pixels': [((17*i) % 256, (3*i*i) % 256, (90 + 7*i) % 256) for i in range(35)]}
+
+    def transpose(self, im):
+        h, w = im['height'], im['width']
+        return {'height': w, 'width': h, 'pixels': [im['pixels'][j*w + i] for i in range(w) for j in range(h)]}
+
+    def test_transposed_view(self):
+        view = lab.transposed(self.im)
+        self.assertEqual(list(view['pixels']), self.transpose(self.im)['pixels'])
+        self.assertEqual(view['pixels'][3:12], self.transpose(self.im)['pixels'][3:12])
+
+    def test_row_seams(self):
+        for nrows in (1, 3):
+            expected = self.transpose(lab.seam_carving(self.transpose(self.im), nrows))
+            self.compare_color_images(lab.seam_carving_rows(self.im, nrows), expected)
+
+    def test_retarget_size(self):
+        oim = object_hash(self.im)
+        result = lab.retarget(self.im, 4, 3)
+        self.assertEqual((result['height'], result['width']), (3, 4))
+        self.assertEqual(len(result['pixels']), 12)
+        self.compare_color_images(lab.retarget(self.im, 4, 5), lab.seam_carving(self.im, 3))
+        self.assertEqual(object_hash(self.im), oim, 'Be careful not to modify the original image!')
+
+
+class TestSeamInsertion(Lab1Test):
+    def test_insertion(self):
+        im = {'height': 4, 'width': 6,
+              'pixels': [((40*i) % 256, (9*i*i) % 256, (250 - 5*i) % 256) for i in range(24)]}
+        oim = object_hash(im)
+        for ncols in (1, 3, 6, 10):
+            result = lab.seam_insertion(im, ncols)
+            self.assertEqual(result['width'], 6 + ncols)
+            self.assertEqual(len(result['pixels']), 4*(6 + ncols))
+        self.assertEqual(object_hash(im), oim, 'Be careful not to modify the original image!')
+
+    def test_inserted_pixels_are_averages(self):
+        im = {'height': 1, 'width': 3, 'pixels': [(0, 0, 0), (10, 20, 31), (255, 255, 255)]}
+        result = lab.image_with_seams(im, [[0], [2]])
+        expected = {'height': 1, 'width': 5,
+                    'pixels': [(0, 0, 0), (5, 10, 16), (10, 20, 31), (255, 255, 255), (255, 255, 255)]}
+        self.compare_color_images(result, expected)
+
+
+class TestCascadeFusion(Lab1Test):
+    def setUp(self):
+        self.im = {'height': 12, 'width': 14, 'pixels': [(37*i*i + 19*i) % 256 for i in range(168)]}
+        self.filters = [lab.make_blur_filter(3, clip=False),
+                        lab.make_sharpen_filter(3, clip=False),
+                        lab.make_blur_filter(3)]
+        self.backend = lab.correlation_backend
+
+    def tearDown(self):
+        lab.set_correlation_backend(self.backend)
+
+    def test_compose_kernels(self):
+        im = {'height': 5, 'width': 5, 'pixels': [0]*12 + [100] + [0]*12}
+        k1 = [[0, 1, 0], [0, 0, 0], [0, 2, 0]]
+        k2 = [[1, 0, -1]]
+        twice = lab.correlate(lab.correlate(im, k1), k2)
+        once = lab.correlate(im, lab.compose_kernels(k1, k2))
+        self.assertEqual(once['pixels'][6:9], twice['pixels'][6:9])
+        self.assertEqual(once['pixels'][16:19], twice['pixels'][16:19])
+
+    def test_fused_cascade_matches_filters_in_turn(self):
+        expected = self.im
+        for filt in self.filters:
+            expected = filt(expected)
+        for backend in lab.CORRELATION_BACKENDS:
+            lab.set_correlation_backend(backend)
+            cascade = lab.filter_cascade(self.filters)
+            result = cascade(self.im)
+            self.assertTrue(isinstance(cascade.explain(), str))
+            with self.subTest(backend=backend):
+                for i, j in zip(result['pixels'], expected['pixels']):
+                    self.assertLessEqual(abs(i - j), 1)
+
+    def test_fused_emboss_on_compact_image(self):
+        color = {'height': 20, 'width': 20,
+                 'pixels': [((7*i) % 256, (31*i*i) % 256, (90 + i*i) % 256) for i in range(400)]}
+        compact = lab.CompactImage.from_dict(color)
+        filters = [lab.make_emboss_filter(3), lab.make_blur_filter(3)]
+        for backend in lab.CORRELATION_BACKENDS:
+            lab.set_correlation_backend(backend)
+            cascade = lab.filter_cascade(filters)
+            for image in (color, compact):
+                expected = image
+                for filt in filters:
+                    expected = filt(expected)
+                result = cascade(image)
+                with self.subTest(backend=backend, image=type(image).__name__):
+                    self.assertEqual(lab.CompactImage.from_dict(result).data,
+                                     lab.CompactImage.from_dict(expected).data)
+
+    def test_clipped_filters_are_not_fused(self):
+        cascade = lab.filter_cascade([lab.make_blur_filter(3), lab.make_blur_filter(3)])
+        self.assertNotIn('fused', cascade.explain())
+
+
+class TestPlanarImage(Lab1Test):
+    def setUp(self):
+        self.im = {'height': 5, 'width': 6,
+                   'pixels': [((23*i) % 256, (i*i) % 256, (128 + 9*i) % 256) for i in range(30)]}
+
+    def test_round_trip(self):
+        planar = lab.PlanarImage.from_image(self.im)
+        self.assertEqual(planar.planes[1]['pixels'], [p[1] for p in self.im['pixels']])
+        self.compare_color_images(planar.to_dict(), self.im)
+
+    def test_cascade_stays_planar(self):
+        filters = [lab.color_filter_from_greyscale_filter(lab.edges),
+                   lab.color_filter_from_greyscale_filter(lab.inverted)]
+        expected = filters[1](filters[0](self.im))
+        cascade = lab.filter_cascade(filters)
+        self.compare_color_images(cascade(self.im), expected)
+        result = cascade(lab.PlanarImage.from_image(self.im))
+        self.assertIsInstance(result, lab.PlanarImage)
+        self.compare_color_images(result.to_dict(), expected)
+
+    def test_cascade_of_unclipped_filters_on_compact_image(self):
+        backend = lab.correlation_backend
+        try:
+            lab.set_correlation_backend('python')
+            filters = [lab.color_filter_from_greyscale_filter(lab.make_blur_filter(3, clip=False)),
+                       lab.color_filter_from_greyscale_filter(lab.make_sharpen_filter(3))]
+            expected = filters[1](filters[0](self.im))
+            result = lab.filter_cascade(filters)(lab.CompactImage.from_dict(self.im))
+            self.assertIsInstance(result, lab.CompactImage)
+            self.compare_color_images(result.to_dict(), expected)
+        finally:
+            lab.set_correlation_backend(backend)
+
+
+class TestTiledFilter(Lab1Test):
+    def setUp(self):
+        self.im = {'height': 23, 'width': 9, 'pixels': [(37*i) % 256 for i in range(23*9)]}
+
+    def test_matches_whole_image(self):
+        for filt in (lab.edges, lab.make_sharpen_filter(5),
+                     lab.filter_cascade([lab.make_blur_filter(3), lab.edges])):
+            with self.subTest(filt=filt):
+                self.compare_greyscale_images(lab.tiled_filter(filt, workers=2, strips=5)(self.im),
+                                              filt(self.im))
+
+    def test_color_and_compact(self):
+        color = {'height': 11, 'width': 7,
+                 'pixels': [((23*i) % 256, (i*i) % 256, (128 + 9*i) % 256) for i in range(77)]}
+        filt = lab.color_filter_from_greyscale_filter(lab.make_blur_filter(3))
+        self.compare_color_images(lab.tiled_filter(filt, workers=2)(color), filt(color))
+        compact = lab.CompactImage.from_dict(self.im)
+        result = lab.tiled_filter(lab.edges, strips=4)(compact)
+        self.assertIsInstance(result, lab.CompactImage)
+        self.compare_greyscale_images(result.to_dict(), lab.edges(self.im))
+
+    def test_unknown_radius(self):
+        with self.assertRaises(ValueError):
+            lab.tiled_filter(lambda image: image)
+
+    def test_pool_is_reused(self):
+        with lab.TiledPool(2) as pool:
+            blur = lab.tiled_filter(lab.make_blur_filter(3), pool=pool, strips=4)
+            edges = lab.tiled_filter(lab.edges, pool=pool, strips=4)
+            starts = []
+            for i in range(3):
+                im = {'height': 23, 'width': 9, 'pixels': [(37*j + i) % 256 for j in range(23*9)]}
+                self.compare_greyscale_images(blur(im), lab.make_blur_filter(3)(im))
+                self.compare_greyscale_images(edges(im), lab.edges(im))
+                starts.append(pool.starts)
+            # started (at most) while the first image sized the buffers
+            self.assertEqual(starts[1:], starts[:1] * 2)
+
+    def test_out_of_range_below_probe(self):
+        # flat top rows sharpen to values in range; the rows below do not
+        im = {'height': 20, 'width': 9, 'pixels': [100]*45 + [(67*i) % 256 for i in range(135)]}
+        kernel = [[0, -1, 0], [-1, 5, -1], [0, -1, 0]]
+
+        def sharpen(image):
+            return lab.correlate(image, kernel)
+        sharpen.radius = 1
+
+        expected = sharpen(im)
+        self.assertTrue(any(v < 0 or v > 255 for v in expected['pixels']))
+        self.assertEqual(lab.tiled_filter(sharpen, workers=2, strips=4)(im), expected)
+
+
+class TestStreaming(Lab1Test):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.im = {'height': 21, 'width': 8, 'pixels': [(41*i) % 256 for i in range(21*8)]}
+        self.color = {'height': 13, 'width': 6,
+                      'pixels': [((23*i) % 256, (i*i) % 256, (128 + 9*i) % 256) for i in range(78)]}
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.dir.name, name)
+
+    def test_greyscale_bands(self):
+        filt = lab.filter_cascade([lab.make_blur_filter(3), lab.make_sharpen_filter(3)])
+        lab.save_image(self.im, self.path('in.png'))
+        for out in ('out.pgm', 'out.png'):
+            for band_rows in (1, 5, 64):
+                with self.subTest(out=out, band_rows=band_rows):
+                    lab.stream_filter(filt, self.path('in.png'), self.path(out), band_rows=band_rows)
+                    self.compare_greyscale_images(lab.load_image(self.path(out)), filt(self.im))
+
+    def test_color_netpbm(self):
+        writer = lab.NetpbmWriter(self.path('in.ppm'), 6, 13, 3)
+        writer.write_rows(bytes(v for p in self.color['pixels'] for v in p))
+        writer.close()
+        filt = lab.color_filter_from_greyscale_filter(lab.edges)
+        lab.stream_filter(filt, self.path('in.ppm'), self.path('out.ppm'), color=True, band_rows=4)
+        self.compare_color_images(lab.load_color_image(self.path('out.ppm')), filt(self.color))
+
+
+class TestBatchPipeline(Lab1Test):
+    def test_process_directory(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.mkdir(os.path.join(tmp, 'in'))
+            images = []
+            for i in range(5):
+                im = {'height': 6 + i, 'width': 5, 'pixels': [(31*j + i) % 256 for j in range(5*(6 + i))]}
+                lab.save_image(im, os.path.join(tmp, 'in', '%d.png' % i))
+                images.append(im)
+            filters = [lab.make_blur_filter(3), lab.inverted]
+            stats = lab.process_images(os.path.join(tmp, 'in'), filters, os.path.join(tmp, 'out'),
+                                       workers=2, prefetch=2)
+            for i, im in enumerate(images):
+                expected = lab.inverted(lab.make_blur_filter(3)(im))
+                self.compare_greyscale_images(lab.load_image(os.path.join(tmp, 'out', '%d.png' % i)), expected)
+            for stage in ('decode', 'filter', 'encode'):
+                self.assertEqual(stats[stage].images, 5)
+
+    def test_color_batch_is_quiet(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            im = {'height': 4, 'width': 3, 'pixels': [(20*i, 255 - 20*i, 7*i) for i in range(12)]}
+            lab.write_image(im, os.path.join(tmp, 'a.png'), color=True)
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                lab.process_images([os.path.join(tmp, 'a.png')], lab.color_filter_from_greyscale_filter(lab.inverted),
+                                   os.path.join(tmp, 'out'), color=True, workers=1)
+            self.assertEqual(output.getvalue(), '')
+            expected = lab.color_filter_from_greyscale_filter(lab.inverted)(im)
+            self.compare_color_images(lab.load_color_image(os.path.join(tmp, 'out', 'a.png')), expected)
+
+
+class TestPointFilters(Lab1Test):
+    def setUp(self):
+        self.im = {'height': 40, 'width': 30, 'pixels': [(7*i) % 256 for i in range(1200)]}
+
+    def test_lookup_table_matches_function(self):
+        self.assertGreaterEqual(len(self.im['pixels']), lab.LUT_MIN_PIXELS)
+        self.assertEqual(lab.inverted(self.im)['pixels'], [255 - c for c in self.im['pixels']])
+        self.assertEqual(lab.threshold(self.im, 100)['pixels'],
+                         [255 if c >= 100 else 0 for c in self.im['pixels']])
+        halves = {'height': 40, 'width': 30, 'pixels': [c + .5 for c in self.im['pixels']]}
+        self.assertEqual(lab.inverted(halves)['pixels'], [254.5 - c for c in self.im['pixels']])
+
+    def test_greyscale_tables(self):
+        color = {'height': 2, 'width': 3,
+                 'pixels': [(255, 0, 0), (0, 255, 0), (0, 0, 255), (1, 2, 3), (128, 128, 128), (255, 255, 255)]}
+        expected = [round(.299*r + .587*g + .114*b) for r, g, b in color['pixels']]
+        self.assertEqual(lab.greyscale_image_from_color_image(color)['pixels'], expected)
+        compact = lab.CompactImage.from_dict(color)
+        self.assertEqual(list(lab.greyscale_image_from_color_image(compact).data), expected)
+
+    def test_cascade_folds_point_filters(self):
+        filters = [lab.inverted, lab.threshold, lab.inverted]
+        cascade = lab.filter_cascade(filters)
+        self.assertEqual(cascade.explain().count('\n'), 0)
+        self.compare_greyscale_images(cascade(self.im), lab.inverted(lab.threshold(lab.inverted(self.im))))
+
+
+class TestClippedOutput(Lab1Test):
+    def test_rounds_halves_to_even(self):
+        values = [-3, -0.5, 0.5, 1.5, 2.5, 127.5, 254.5, 255.5, 300, 12.49]
+        self.assertEqual(list(lab.clipped_bytes(values)), [0, 0, 0, 2, 2, 128, 254, 255, 255, 12])
+        im = {'height': 2, 'width': 5, 'pixels': list(values)}
+        pixels = im['pixels']
+        self.assertIs(lab.round_and_clip_image(im)['pixels'], pixels)
+        self.assertEqual(pixels, [0, 0, 0, 2, 2, 128, 254, 255, 255, 12])
+
+    def test_filters_match_round_and_clip(self):
+        im = {'height': 9, 'width': 7, 'pixels': [(53*i) % 256 for i in range(63)]}
+        for n in (2, 3, 5):
+            with self.subTest(n=n):
+                expected = lab.round_and_clip_image(lab.sharpened(im, n, clip=False))
+                self.compare_greyscale_images(lab.sharpened(im, n), expected)
+                expected = lab.round_and_clip_image(lab.correlate(im, lab.blurred_kernel(n)))
+                self.compare_greyscale_images(lab.blurred(im, n), expected)
+
+
+class TestIntegralImage(Lab1Test):
+    def setUp(self):
+        self.im = {'height': 7, 'width': 10, 'pixels': [(29*i) % 256 for i in range(70)]}
+
+    def test_box_sum_clamps_like_get_pixel(self):
+        table = lab.IntegralImage(self.im)
+        for row, col, nrows, ncols in ((0, 0, 7, 10), (2, 3, 2, 4), (-3, -2, 5, 4), (5, 8, 6, 6), (-4, 12, 2, 3)):
+            expected = sum(lab.get_pixel(self.im, x, y)
+                           for x in range(row, row + nrows) for y in range(col, col + ncols))
+            self.assertEqual(table.box_sum(row, col, nrows, ncols), expected)
+
+    def test_blurs_of_every_size(self):
+        blurs = lab.blurred_sizes(self.im, [1, 3, 5, 11])
+        for n, result in blurs.items():
+            with self.subTest(n=n):
+                self.compare_greyscale_images(result, lab.blurred(self.im, n))
+        with self.assertRaises(ValueError):
+            lab.IntegralImage(self.im).blurred(4)
+
+
+class TestFilterCache(Lab1Test):
+    def setUp(self):
+        self.im = {'height': 6, 'width': 8, 'pixels': [(17*i) % 256 for i in range(48)]}
+
+    def test_factories_are_memoized(self):
+        self.assertIs(lab.make_blur_filter(3), lab.make_blur_filter(3))
+        self.assertIsNot(lab.make_blur_filter(3), lab.make_blur_filter(3, clip=False))
+        lab.make_sharpen_filter(3)
+        self.assertEqual(lab.blurred_kernel(3)[1][1], 1/9)
+        for cached in (lab.blurred_kernel, lab.emboss_kernel, lab.make_blur_filter):
+            self.assertEqual(cached.cache_info().maxsize, lab.FACTORY_CACHE_SIZE)
+
+    def test_hits_misses_and_eviction(self):
+        cache = lab.FilterCache(max_entries=2)
+        blur = cache.wrap(lab.make_blur_filter(3))
+        first = blur(self.im)
+        first['pixels'][0] = -1
+        self.compare_greyscale_images(blur(self.im), lab.blurred(self.im, 3))
+        self.assertEqual((cache.stats()['hits'], cache.stats()['misses']), (1, 1))
+        cache.apply(lab.blurred, self.im, 5)
+        cache.apply(lab.blurred, self.im, 7)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.stats()['evictions'], 1)
+        other = {'height': 6, 'width': 8, 'pixels': list(reversed(self.im['pixels']))}
+        cache.apply(lab.blurred, other, 7)
+        self.assertEqual(cache.stats()['misses'], 4)
+
+
+class TestEnergyFunctions(Lab1Test):
+    def setUp(self):
+        self.im = {'height': 12, 'width': 15,
+                   'pixels': [((37*i) % 256, (i*i) % 256, (128 + 11*i) % 256) for i in range(180)]}
+        self.grey = lab.greyscale_image_from_color_image(self.im)
+
+    def test_l1_energy(self):
+        gx = lab.correlate(self.grey, [[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]])['pixels']
+        gy = lab.correlate(self.grey, [[-1, -2, -1], [0, 0, 0], [1, 2, 1]])['pixels']
+        self.assertEqual(lab.energy_l1(self.grey)['pixels'], [abs(x) + abs(y) for x, y in zip(gx, gy)])
+
+    def test_incremental_l1_matches_recomputing(self):
+        expected = self.im
+        for i in range(4):
+            grey = lab.greyscale_image_from_color_image(expected)
+            expected = lab.image_without_seam(expected, lab.find_seam(grey, 'l1'))
+        self.compare_color_images(lab.seam_carving(self.im, 4, energy='l1'), expected)
+
+    def test_forward_energy_seam_is_connected(self):
+        seam = lab.forward_energy_seam(self.grey)
+        cols = [x % 15 for x in seam]
+        self.assertEqual([x // 15 for x in seam], list(range(11, -1, -1)))
+        self.assertTrue(all(abs(a - b) <= 1 for a, b in zip(cols, cols[1:])))
+
+    def test_pyramid_with_wide_band_is_exact(self):
+        self.assertEqual(lab.pyramid_seam(self.grey, 'sobel', 1, band=15), lab.find_seam(self.grey))
+        for kwargs in ({'energy': 'downsampled'}, {'energy': 'forward'}, {'pyramid': 1}, {'pyramid': 2, 'energy': 'l1'}):
+            with self.subTest(**kwargs):
+                result = lab.seam_carving(self.im, 3, **kwargs)
+                self.assertEqual((result['height'], result['width']), (12, 12))
+
+    def test_unknown_energy(self):
+        with self.assertRaises(ValueError):
+            lab.seam_carving(self.im, 1, energy='laplacian')
+
+
+class TestCompactSeamSearch(Lab1Test):
+    def test_matches_cumulative_map_with_ties(self):
+        energies = [{'height': 4, 'width': 5, 'pixels': [(7*i) % 3 for i in range(20)]},
+                    {'height': 3, 'width': 4, 'pixels': [1]*12},
+                    {'height': 1, 'width': 3, 'pixels': [2, 0, 0]},
+                    {'height': 5, 'width': 1, 'pixels': [4, 3, 2, 1, 0]}]
+        for energy in energies:
+            with self.subTest(energy=energy):
+                cem = lab.cumulative_energy_map(energy)
+                cost, seam = lab.minimum_seam(energy)
+                self.assertEqual(seam, lab.minimum_energy_seam(cem))
+                self.assertEqual(cost, min(cem['pixels'][-energy['width']:]))
+
+    def test_one_signed_byte_per_pixel(self):
+        grey = {'height': 6, 'width': 7, 'pixels': [(31*i) % 256 for i in range(42)]}
+        cem, back = lab.forward_cumulative_map(grey)
+        self.assertEqual((back.typecode, len(back)), ('b', 42))
+        self.assertTrue(set(back) <= {-1, 0, 1})
+
+
+class TestCorrelationMethods(Lab1Test):
+    def setUp(self):
+        self.im = {'height': 19, 'width': 23, 'pixels': [(71*i + 5) % 256 for i in range(19*23)]}
+
+    def assertClose(self, result, expected, kernel):
+        tolerance = lab.correlation_tolerance(kernel)
+        for i, j in zip(result['pixels'], expected['pixels']):
+            self.assertLessEqual(abs(i - j), tolerance)
+
+    def test_separable(self):
+        col, row = [1, -2, 0.5, 3, 1], [0.25, 1, 2]
+        kernel = [[c*r for r in row] for c in col]
+        self.assertIsNotNone(lab.separate_kernel(kernel))
+        self.assertIsNone(lab.separate_kernel([[1, 2], [3, 4]]))
+        expected = lab.correlate(self.im, kernel, method='direct')
+        for backend in lab.CORRELATION_BACKENDS:
+            with self.subTest(backend=backend):
+                self.assertClose(lab.correlate(self.im, kernel, backend, 'separable'), expected, kernel)
+
+    @unittest.skipIf(lab.numpy is None, 'needs NumPy')
+    def test_fft_matches_direct(self):
+        kernel = [[((7*i + 3*j) % 11 - 5) / 30 for j in range(21)] for i in range(17)]
+        expected = lab.correlate(self.im, kernel, method='direct')
+        self.assertClose(lab.correlate(self.im, kernel, method='fft'), expected, kernel)
+        self.assertEqual(lab.choose_correlation_method(kernel), 'fft')
+
+    def test_direct_is_the_default(self):
+        self.assertEqual(lab.correlation_method, 'direct')
+        kernel = [[((3*i + j) % 5 - 2) / 7 for j in range(17)] for i in range(15)]
+        self.assertEqual(lab.correlate(self.im, kernel)['pixels'],
+                         lab.correlate(self.im, kernel, method='direct')['pixels'])
+
+    def test_small_kernels_stay_direct(self):
+        self.assertEqual(lab.choose_correlation_method(lab.blurred_kernel(15)), 'direct')
+        kernel = [[1, 2, 1], [0, 0, 0], [-1, -2, -1]]
+        self.assertEqual(lab.correlate(self.im, kernel)['pixels'],
+                         lab.correlate(self.im, kernel, method='direct')['pixels'])
+
+    def test_unknown_method(self):
+        with self.assertRaises(ValueError):
+            lab.correlate(self.im, [[1]], method='winograd')
+
+
+class TestImagePyramid(Lab1Test):
+    def setUp(self):
+        self.im = {'height': 21, 'width': 30, 'pixels': [(37*i + 11) % 256 for i in range(21*30)]}
+
+    def test_levels_are_lazy(self):
+        pyramid = lab.ImagePyramid(self.im)
+        self.assertEqual(len(pyramid), 6)
+        self.assertEqual(len(pyramid.levels), 1)
+        self.assertEqual(pyramid.level(1), lab.area_downsample(self.im))
+        self.assertEqual(len(pyramid.levels), 2)
+        top = pyramid.level(5)
+        self.assertEqual((top['height'], top['width']), (1, 1))
+        self.assertRaises(IndexError, pyramid.level, 6)
+        self.assertEqual(pyramid.level_for(15), 1)
+        self.assertEqual(pyramid.level_for(100), 0)
+
+    def test_results_cached_per_level(self):
+        pyramid = lab.ImagePyramid(self.im)
+        expected = lab.inverted(pyramid.level(2))
+        self.assertEqual(pyramid.apply(lab.inverted, 2), expected)
+        result = pyramid.apply(lab.inverted, 2)
+        self.assertEqual(result, expected)
+        self.assertEqual(pyramid.hits, 1)
+        result['pixels'][0] = -1
+        self.assertEqual(pyramid.apply(lab.inverted, 2), expected)
+
+    def test_blurred_scales_with_level(self):
+        pyramid = lab.ImagePyramid(self.im)
+        self.assertEqual(pyramid.blurred(9, 0), lab.blurred(self.im, 9))
+        self.assertEqual(pyramid.blurred(9, 1), lab.blurred(pyramid.level(1), 5))
+        color = {'height': 5, 'width': 6, 'pixels': [(i, 2*i, 255 - i) for i in range(30)]}
+        blur = lab.color_filter_from_greyscale_filter(lab.make_blur_filter(3))
+        self.assertEqual(lab.ImagePyramid(color).blurred(5, 1), blur(lab.downsample_image(color)))
+
+
 def load_greyscale_image(filename):
     """
     Loads an image from the given file and returns a dictionary
@@ -19,6 +19,8 @@ import pickle
 # function that takes a data set and returns boolean of whether actors have acted together
 # checks every data point
 def acted_together(data, actor_id_1, actor_id_2):
+    if isinstance(data, ActorGraph):
+        return data.film(actor_id_1, actor_id_2) is not None
     for x in data:
         if (x[0] == actor_id_1 and x[1] == actor_id_2) or (x[1] == actor_id_1 and x[0] == actor_id_2):
             return True
@@ -27,7 +29,11 @@ def acted_together(data, actor_id_1, actor_id_2):
 
 # constructs tree from given data
 # tree returns dictionary for each bacon number
+# a BaconIndex already has the actors of each bacon number
 def actors_with_bacon_number(data, n):
+    if isinstance(data, BaconIndex):
+        return set(data.layer(n))
+
     tree = construct_tree(data, 4724)
     final = set()
 
@@ -42,58 +48,46 @@ def actors_with_bacon_number(data, n):
 # can also be used to construct a tree from any other start_id and find path to any end_id
 # change path parameter to True to print out path
 # add in end_set parameter if construct_tree is being used to find the shortest path to any actor in a list
-def construct_tree(data, start_id=4724, end_id=0, path = False, end_set=set()):
-    connected_actors = dictionary_links(data)
+# data is the list of (actor, actor, film) triples or an ActorGraph built from it
+# bidirectional and stats are passed on to path_search
+def construct_tree(data, start_id=4724, end_id=0, path = False, end_set=set(), bidirectional=False, stats=None):
+    graph = actor_graph(data)
 
+    # if returning parent path - search until one of the goals is reached
+    if path:
+        found = path_search(graph, start_id, end_id, end_set, bidirectional, stats)
+        if found is None:
+            return None
+        return graph.actor_ids(found[0])
+
+    if start_id not in graph:
+        return {start_id: 0}
+
+    distances = graph.distances(graph.index[start_id])
+    ids = graph.ids
+    return {ids[i]: n for i, n in enumerate(distances) if n >= 0}
+
+
+# shortest path in graph from start_id to end_id or to any actor in end_set,
+# as (actor numbers, links), or None
+# bidirectional=True searches from both ends when there is a single end actor;
+# the path found may differ from the one-sided search, but has the same length
+# if stats is a dictionary, stats['expanded'] is set to the number of actors
+# whose neighbors were looked at
+def path_search(graph, start_id, end_id=0, end_set=set(), bidirectional=False, stats=None):
     # if searching for path and end_set does not exist - return None
-    if path and (end_id not in connected_actors) and not end_set:
+    if (end_id not in graph and not end_set) or start_id not in graph:
         return None
 
-    bacon_number_dict = {}
-
-    working_set = {start_id}
-    checked = set()
-    n = 0
-
-    # if returning parent path - define appropriate vars
-    if path:
-        parents = {start_id: None}
-        found = False
-
-    # move through list until working set is empty
-    while working_set:
-
-        new_set = set()
-
-        for actor in working_set:
-            bacon_number_dict[actor] = n
+    start = graph.index[start_id]
+    goals = graph.numbers(end_set)
+    if end_id in graph:
+        goals.add(graph.index[end_id])
 
-            if path:
-                for a in connected_actors[actor]:
-                    if a not in parents:
-                        parents[a] = actor
-                        # used for actors_connecting_films, the first end actor path found is returned
-                        if len(end_set) > 0 and a in end_set:
-                            return trace_path(parents, a)
-                        # if specific end_id is found, return path to it
-                        if a == end_id:
-                            found = True
-                            return trace_path(parents, end_id)
-
-            new_set |= connected_actors[actor]
-
-        checked |= working_set
-
-        new_set -= checked
-
-        working_set = new_set.copy()
-
-        n += 1
-    # if no path is found
-    if path and not found:
-        return None
-
-    return bacon_number_dict
+    # (the one-sided search never counts start as a goal)
+    if bidirectional and len(goals) == 1 and start not in goals:
+        return graph.bidirectional_search(start, goals.pop(), stats)
+    return graph.search(start, goals, stats)
 
 
 # retrace path of given actor
@@ -108,6 +102,410 @@ def trace_path(parents, actor):
     return path
 
 
+# ACTOR GRAPH INDEX
+
+class ActorGraph:
+    """
+    Index of the actor graph, built once from the (actor, actor, film)
+    triples so that queries don't rebuild it every time.  Actors are
+    renumbered 0..n-1 (ids[i] is the actor id of number i and index maps an
+    actor id back to its number).  Adjacency is stored compressed: the
+    neighbors of actor number i are neighbors[offsets[i]:offsets[i + 1]],
+    and films[k] is the film the two actors of link k were in together (a
+    pair of actors in several films has a link for each).
+
+    All the query functions accept an ActorGraph in place of the data:
+        graph = ActorGraph(large)
+        bacon_path(graph, 1204)
+        movie_path(graph, 4724, 1640)
+    """
+    def __init__(self, data):
+        self.ids = []
+        self.index = {}
+        index = self.index
+        ids = self.ids
+
+        # first pass: number the actors and count their links
+        # (each triple is a link both ways)
+        degree = []
+        pairs = []
+        for x in data:
+            a = index.get(x[0])
+            if a is None:
+                a = index[x[0]] = len(ids)
+                ids.append(x[0])
+                degree.append(0)
+            b = index.get(x[1])
+            if b is None:
+                b = index[x[1]] = len(ids)
+                ids.append(x[1])
+                degree.append(0)
+            degree[a] += 1
+            degree[b] += 1
+            pairs.append((a, b, x[2]))
+
+        self.offsets = [0] * (len(ids) + 1)
+        for i in range(len(ids)):
+            self.offsets[i + 1] = self.offsets[i] + degree[i]
+
+        # second pass: fill in each actor's slice of neighbors and films
+        self.neighbors = [0] * self.offsets[-1]
+        self.films = [None] * self.offsets[-1]
+        position = self.offsets[:-1]
+        for a, b, film in pairs:
+            k = position[a]
+            self.neighbors[k] = b
+            self.films[k] = film
+            position[a] = k + 1
+            k = position[b]
+            self.neighbors[k] = a
+            self.films[k] = film
+            position[b] = k + 1
+        self._movies = None
+
+    # film -> set of actor ids in it, worked out from the links when first needed
+    @property
+    def movies(self):
+        if self._movies is None:
+            movs = {}
+            for a in range(len(self.ids)):
+                for k in range(self.offsets[a], self.offsets[a + 1]):
+                    if self.films[k] not in movs:
+                        movs[self.films[k]] = set()
+                    movs[self.films[k]].add(self.ids[a])
+            self._movies = movs
+        return self._movies
+
+    # set of the numbers of those actor ids that are in the graph
+    def numbers(self, actor_ids):
+        return {self.index[a] for a in actor_ids if a in self.index}
+
+    def actor_ids(self, numbers):
+        return [self.ids[i] for i in numbers]
+
+    # a film both actors were in, or None if they never acted together
+    def film(self, actor_id_1, actor_id_2):
+        if actor_id_1 not in self.index or actor_id_2 not in self.index:
+            return None
+        a = self.index[actor_id_1]
+        b = self.index[actor_id_2]
+        for k in range(self.offsets[a], self.offsets[a + 1]):
+            if self.neighbors[k] == b:
+                return self.films[k]
+        return None
+
+    # breadth first search from actor number start
+    # returns the distance to every actor number (-1 where unreachable)
+    def distances(self, start):
+        return self.search_tree(start)[1]
+
+    # breadth first search tree from actor number start
+    # returns the actors reached in the order they were reached (so by
+    # distance), the distance to every actor number (-1 where unreachable)
+    # and the actor each one was reached from (-1 for start and unreachable)
+    def search_tree(self, start):
+        offsets = self.offsets
+        neighbors = self.neighbors
+        distance = [-1] * len(self.ids)
+        parent = [-1] * len(self.ids)
+        distance[start] = 0
+        queue = [start]
+        for actor in queue:
+            n = distance[actor] + 1
+            for k in range(offsets[actor], offsets[actor + 1]):
+                a = neighbors[k]
+                if distance[a] < 0:
+                    distance[a] = n
+                    parent[a] = actor
+                    queue.append(a)
+        return queue, distance, parent
+
+    # breadth first search from actor number start until a neighbor in goals
+    # is found (start itself is never a goal, as in construct_tree)
+    # returns the path as actor numbers and the links (positions in
+    # neighbors/films) along it, or None if no goal can be reached
+    # stats (a dictionary, if given) gets the number of actors expanded
+    def search(self, start, goals, stats=None):
+        offsets = self.offsets
+        neighbors = self.neighbors
+        # parent[a] is the actor a was reached from, via[a] the link used
+        parent = [-1] * len(self.ids)
+        via = [-1] * len(self.ids)
+        parent[start] = start
+        queue = [start]
+        expanded = 0
+        found = None
+        for actor in queue:
+            expanded += 1
+            for k in range(offsets[actor], offsets[actor + 1]):
+                a = neighbors[k]
+                if parent[a] < 0:
+                    parent[a] = actor
+                    via[a] = k
+                    if a in goals:
+                        found = self.trace(parent, via, start, a)
+                        break
+                    queue.append(a)
+            if found is not None:
+                break
+        if stats is not None:
+            stats['expanded'] = expanded
+        return found
+
+    # breadth first search from both start and goal at once, one whole layer
+    # at a time, always growing the side with the smaller frontier; stops at
+    # the end of the first layer in which the two sides meet, with the
+    # shortest of the paths through the links found between them
+    # returns (actor numbers, links) like search, or None
+    def bidirectional_search(self, start, goal, stats=None):
+        offsets = self.offsets
+        neighbors = self.neighbors
+        # for each side: actor -> (actor it was reached from, link, distance)
+        forward = {start: (None, -1, 0)}
+        backward = {goal: (None, -1, 0)}
+        forward_layer = [start]
+        backward_layer = [goal]
+        expanded = 0
+        best = None
+
+        while forward_layer and backward_layer and best is None:
+            grow_forward = len(forward_layer) <= len(backward_layer)
+            if grow_forward:
+                layer, seen, other = forward_layer, forward, backward
+            else:
+                layer, seen, other = backward_layer, backward, forward
+
+            new_layer = []
+            for actor in layer:
+                expanded += 1
+                n = seen[actor][2] + 1
+                for k in range(offsets[actor], offsets[actor + 1]):
+                    a = neighbors[k]
+                    if a in other:
+                        length = n + other[a][2]
+                        if best is None or length < best[0]:
+                            best = (length, actor, k, a) if grow_forward else (length, a, k, actor)
+                    elif a not in seen:
+                        seen[a] = (actor, k, n)
+                        new_layer.append(a)
+
+            if grow_forward:
+                forward_layer = new_layer
+            else:
+                backward_layer = new_layer
+
+        if stats is not None:
+            stats['expanded'] = expanded
+        if best is None:
+            return None
+
+        # splice: start ... actor on the forward side, the meeting link, then
+        # the actor on the backward side ... goal
+        length, actor, k, a = best
+        path, links = self.trace_parents(forward, actor)
+        path.reverse()
+        links.reverse()
+        links.append(k)
+        after, after_links = self.trace_parents(backward, a)
+        return path + after, links + after_links
+
+    # actors and links from actor back to the root of a search side
+    def trace_parents(self, seen, actor):
+        path = [actor]
+        links = []
+        while seen[actor][0] is not None:
+            links.append(seen[actor][1])
+            actor = seen[actor][0]
+            path.append(actor)
+        return path, links
+
+    # path (actor numbers, links) from start to actor in a search tree
+    def trace(self, parent, via, start, actor):
+        path = [actor]
+        links = []
+        while actor != start:
+            links.append(via[actor])
+            actor = parent[actor]
+            path.append(actor)
+        path.reverse()
+        links.reverse()
+        return path, links
+
+    def __contains__(self, actor_id):
+        return actor_id in self.index
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __repr__(self):
+        return 'ActorGraph(%d actors, %d links)' % (len(self.ids), len(self.neighbors) // 2)
+
+
+# the ActorGraph for data (data itself if it already is one)
+def actor_graph(data):
+    if isinstance(data, ActorGraph):
+        return data
+    return ActorGraph(data)
+
+
+# BACON NUMBER INDEX
+
+# where load_bacon_index keeps the index, next to the databases
+BACON_INDEX_FILE = 'resources/bacon_index.pickle'
+
+
+# fingerprint of the triples data[:count] (all of them by default), so a saved
+# index is never used with data it was not built from (None for an ActorGraph,
+# whose triples are not kept)
+# hash() of tuples of ints is the same in every run; ids that are strings hash
+# differently each run, which only means the index is rebuilt
+def triples_fingerprint(data, count=None):
+    if isinstance(data, ActorGraph):
+        return None
+    if count is None:
+        count = len(data)
+    return hash(tuple(tuple(x) for x in data[:count]))
+
+
+class BaconIndex:
+    """
+    Bacon numbers from one center actor, worked out once with a breadth
+    first search and kept so that queries don't search again.  layers[n] is
+    the sorted list of actors with Bacon number n, and parents maps every
+    reached actor to the actor it was reached from (None for the center),
+    so a Bacon path is a walk up the parents.
+
+    The index remembers how many triples it was built from and a
+    fingerprint of them.  update(data) checks that those triples are still
+    the start of data and then looks only at the triples appended since:
+    most of them leave every Bacon number as it is, and the index is only
+    rebuilt when one doesn't (or when data is not the same database).
+
+        index = load_bacon_index(large)     # built and saved the first time
+        actors_with_bacon_number(index, 6)
+        bacon_path(index, 1204)
+    """
+    def __init__(self, data, center=4724):
+        self.center = center
+        self.rebuild(data)
+
+    def rebuild(self, data):
+        graph = actor_graph(data)
+        self.triples = len(graph.neighbors) // 2
+        self.fingerprint = triples_fingerprint(data)
+        self.layers = [[self.center]]
+        self.parents = {self.center: None}
+        if self.center in graph:
+            order, distance, parent = graph.search_tree(graph.index[self.center])
+            ids = graph.ids
+            self.layers = []
+            for a in order:
+                if distance[a] == len(self.layers):
+                    self.layers.append([])
+                self.layers[-1].append(ids[a])
+                self.parents[ids[a]] = ids[parent[a]] if parent[a] >= 0 else None
+            for layer in self.layers:
+                layer.sort()
+        self.number_layers()
+
+    # Bacon number of every reached actor, from the layers
+    def number_layers(self):
+        self.distance = {}
+        for n, layer in enumerate(self.layers):
+            for a in layer:
+                self.distance[a] = n
+
+    # sorted list of the actors with Bacon number n
+    def layer(self, n):
+        if 0 <= n < len(self.layers):
+            return self.layers[n]
+        return []
+
+    # path from the center to actor_id, or None if it has no Bacon number
+    # (or is the center itself, as in construct_tree)
+    def path(self, actor_id):
+        if actor_id not in self.parents or actor_id == self.center:
+            return None
+        path = []
+        while actor_id is not None:
+            path.append(actor_id)
+            actor_id = self.parents[actor_id]
+        path.reverse()
+        return path
+
+    # whether the index was built from exactly these triples
+    def matches(self, data):
+        return (self.fingerprint is not None and not isinstance(data, ActorGraph) and
+                len(data) == self.triples and triples_fingerprint(data) == self.fingerprint)
+
+    # brings the index up to date with data: if data is the data it was built
+    # from with more triples appended, only the new triples are looked at,
+    # otherwise the index is rebuilt
+    # a new link changes no Bacon number if it joins two actors whose numbers
+    # differ by at most one, or two actors that both have none; any other
+    # link means a rebuild
+    # returns True if the index had to be rebuilt
+    def update(self, data):
+        if (isinstance(data, ActorGraph) or len(data) < self.triples or self.fingerprint is None or
+                triples_fingerprint(data, self.triples) != self.fingerprint):
+            self.rebuild(data)
+            return True
+        distance = self.distance
+        for i in range(self.triples, len(data)):
+            a = distance.get(data[i][0])
+            b = distance.get(data[i][1])
+            if (a is None) != (b is None) or a is not None and abs(a - b) > 1:
+                self.rebuild(data)
+                return True
+        self.triples = len(data)
+        self.fingerprint = triples_fingerprint(data)
+        return False
+
+    def save(self, filename=BACON_INDEX_FILE):
+        with open(filename, 'wb') as f:
+            pickle.dump({'center': self.center, 'triples': self.triples, 'fingerprint': self.fingerprint,
+                         'layers': self.layers, 'parents': self.parents}, f)
+
+    @classmethod
+    def load(cls, filename=BACON_INDEX_FILE):
+        with open(filename, 'rb') as f:
+            saved = pickle.load(f)
+        index = cls.__new__(cls)
+        index.center = saved['center']
+        index.triples = saved['triples']
+        index.fingerprint = saved['fingerprint']
+        index.layers = saved['layers']
+        index.parents = saved['parents']
+        index.number_layers()
+        return index
+
+    def __len__(self):
+        return len(self.parents)
+
+    def __repr__(self):
+        return 'BaconIndex(center=%r, %d actors in %d layers)' % (self.center, len(self.parents), len(self.layers))
+
+
+# the BaconIndex for data saved in filename, brought up to date with data
+# (see BaconIndex.update) and saved again if it changed; built and saved if
+# there is no saved index for this center yet
+# the file holds one index; loading it for another database rebuilds it
+def load_bacon_index(data, filename=BACON_INDEX_FILE, center=4724):
+    try:
+        index = BaconIndex.load(filename)
+    except (OSError, EOFError, pickle.UnpicklingError, KeyError):
+        index = None
+
+    if index is None or index.center != center:
+        index = BaconIndex(data, center)
+    elif index.matches(data):
+        return index
+    else:
+        index.update(data)
+    index.save(filename)
+    return index
+
+
 # HELPER FUNCTION: returns dictionary of all connected actors
 def dictionary_links(data):
     connected_actors = {}
@@ -125,66 +523,58 @@ def dictionary_links(data):
 
 # Use construct tree with start id at Bacon and moving to desired end actor
 # Path is true - returning path list
+# a BaconIndex walks its stored parents instead (from its own center)
 def bacon_path(data, actor_id):
+    if isinstance(data, BaconIndex):
+        return data.path(actor_id)
     start_id = 4724
     return construct_tree(data, start_id, actor_id, path=True)
 
 
 # use construct tree and pather = True
 # only pass end set if checking for shortest path to a set of actors
-def actor_to_actor_path(data, actor_id_1, actor_id_2, end_set=set()):
-    return construct_tree(data, actor_id_1, actor_id_2, path=True, end_set=end_set)
+# searches from both actors at once unless bidirectional=False (see path_search)
+def actor_to_actor_path(data, actor_id_1, actor_id_2, end_set=set(), bidirectional=True, stats=None):
+    return construct_tree(data, actor_id_1, actor_id_2, path=True, end_set=end_set,
+                          bidirectional=bidirectional, stats=stats)
 
 
 # find shortest movie path between two actors
-# use actor_to_actor_path to find shortest path
-def movie_path(data, actor_id_1, actor_id_2):
-    path = actor_to_actor_path(data, actor_id_1, actor_id_2)
-
-    mov = []
-    # for each edge in the path, find a movie that connects them
-    # break early to prevent adding multiple movies per pair
-    for i in range(len(path) - 1):
-        for x in data:
-            if x[0] == path[i] and x[1] == path[i + 1] or x[1] == path[i] and x[0] == path[i + 1]:
-                mov.append(x[2])
-                break
-    return mov
+# searches the ActorGraph like actor_to_actor_path; the films are read off
+# the links of the path found (None if there is no path)
+def movie_path(data, actor_id_1, actor_id_2, bidirectional=True, stats=None):
+    graph = actor_graph(data)
+    found = path_search(graph, actor_id_1, actor_id_2, bidirectional=bidirectional, stats=stats)
+    if found is None:
+        return None
+    return [graph.films[k] for k in found[1]]
 
 
 # generalizes actor_to_actor for a given list of end goal actors
-# run actor_to_actor for each actor in list
+# a single search stops at whichever goal actor it reaches first
 def actor_path(data, actor_id_1, goal_test_function):
-    # get list of all actors in dictionary
+    # get list of all actors in the graph
     # if test_function returns true, add actor to list
-    # use actor_to_actor_path to test valid path
 
     if goal_test_function(0) or goal_test_function(actor_id_1):
         return [actor_id_1]
 
-    full_dict = dictionary_links(data)
-    search_list = []
-    for actor in full_dict:
-        if goal_test_function(actor):
-            search_list.append(actor)
-
-    paths = []
-
-    for actor in search_list:
-        path = actor_to_actor_path(data, actor_id_1, actor)
-        if path != None:
-            paths.append(path)
+    graph = actor_graph(data)
+    search_list = [i for i, actor in enumerate(graph.ids) if goal_test_function(actor)]
+    if not search_list or actor_id_1 not in graph:
+        return None
 
-    if len(paths) > 0:
-        shortest = paths[0]
-        for p in paths:
-            if len(p) < len(shortest):
-                shortest = p
-        return shortest
+    # one search for the nearest of them gives the shortest of all the paths
+    found = graph.search(graph.index[actor_id_1], set(search_list))
+    if found is None:
+        return None
+    return graph.actor_ids(found[0])
 
 
 # HELPER FUNCTION to create dictionary of movies and actors in them
 def movie_dictionary(data):
+    if isinstance(data, ActorGraph):
+        return data.movies
     movs = {}
     for x in data:
         if x[2] not in movs:
@@ -200,6 +590,7 @@ def movie_dictionary(data):
 # for each given set, actor path function will return the path to the first node found
 # return shortest overall path
 def actors_connecting_films(data, film1, film2):
+    data = actor_graph(data)
     movs = movie_dictionary(data)
 
     actors1 = movs[film1]
@@ -451,6 +451,128 @@ class Test06_ActorsConnectingFilms(unittest.TestCase):
         self.check_connected_movie_path(142416, 44521)
 
 
+class Test07_ActorGraph(unittest.TestCase):
+    def setUp(self):
+        self.data = [(4724, 1, 10), (1, 2, 11), (2, 3, 12), (4724, 4, 13), (4, 3, 14), (1, 2, 15), (5, 6, 16)]
+        self.graph = lab.ActorGraph(self.data)
+
+    def test_index(self):
+        self.assertEqual(len(self.graph), 7)
+        self.assertIn(6, self.graph)
+        self.assertNotIn(7, self.graph)
+        self.assertIn(self.graph.film(2, 1), {11, 15})
+        self.assertIsNone(self.graph.film(1, 3))
+        self.assertTrue(lab.acted_together(self.graph, 3, 4))
+        self.assertEqual(lab.movie_dictionary(self.graph), lab.movie_dictionary(self.data))
+
+    def test_queries_accept_index(self):
+        for data in (self.data, self.graph):
+            self.assertEqual(lab.actors_with_bacon_number(data, 2), {2, 3})
+            self.assertEqual(lab.bacon_path(data, 3), [4724, 4, 3])
+            self.assertEqual(lab.movie_path(data, 4724, 3), [13, 14])
+            self.assertEqual(lab.actor_path(data, 2, lambda p: p in {4, 6}), [2, 3, 4])
+            self.assertIsNone(lab.actor_to_actor_path(data, 4724, 6))
+
+    def test_bacon_tree(self):
+        N = random.randint(20, 40)
+        k = random.randint(3, 10)
+        graph = lab.ActorGraph(make_bacon_tree(N, k))
+        self.assertEqual(len(lab.actors_with_bacon_number(graph, N)), k)
+
+
+class Test08_BidirectionalSearch(unittest.TestCase):
+    def test_same_length_as_one_sided(self):
+        data = make_bacon_tree(30, 6)
+        graph = lab.ActorGraph(data)
+        actors = list(graph.ids)
+        for _ in range(20):
+            x, y = random.choice(actors), random.choice(actors)
+            one_sided = lab.actor_to_actor_path(graph, x, y, bidirectional=False)
+            p = lab.actor_to_actor_path(graph, x, y)
+            self.assertEqual(p is None, one_sided is None)
+            if p is not None:
+                self.assertEqual(len(p), len(one_sided))
+                self.assertTrue(valid_path(data, p))
+                self.assertEqual((p[0], p[-1]), (x, y))
+                self.assertEqual(len(lab.movie_path(graph, x, y)), len(p) - 1)
+
+    def test_expands_fewer_actors(self):
+        # two long chains from 4724, joined at their far ends by 0
+        e = random_number_list(50, 1)
+        f = random_number_list(50, 2)
+        path = [4724] + e + [0] + f[::-1] + [4724]
+        data = [(i, j, 0) for i, j in zip(path, path[1:])]
+        data += [(4724, k, 1) for k in random_number_list(200, 3)]
+        one_sided = {}
+        both = {}
+        p = lab.actor_to_actor_path(data, 4724, e[40], bidirectional=False, stats=one_sided)
+        self.assertEqual(lab.actor_to_actor_path(data, 4724, e[40], stats=both), p)
+        self.assertLess(both['expanded'], one_sided['expanded'])
+
+    def test_disconnected(self):
+        data = [(1, 2, 0), (3, 4, 0)]
+        stats = {}
+        self.assertIsNone(lab.actor_to_actor_path(data, 1, 4, stats=stats))
+        self.assertIsNone(lab.movie_path(data, 1, 4))
+        self.assertIsNone(lab.actor_to_actor_path(data, 1, 1))
+        self.assertLessEqual(stats['expanded'], 2)
+
+
+class Test09_BaconIndex(unittest.TestCase):
+    def setUp(self):
+        self.data = make_bacon_tree(random.randint(20, 40), random.randint(3, 8))
+        self.filename = os.path.join(TEST_DIRECTORY, 'test_bacon_index.pickle')
+
+    def tearDown(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def test_layers_and_paths(self):
+        index = lab.BaconIndex(self.data)
+        tree = lab.construct_tree(self.data)
+        for n in range(max(tree.values()) + 2):
+            layer = index.layer(n)
+            self.assertEqual(layer, sorted(layer))
+            self.assertEqual(lab.actors_with_bacon_number(index, n), lab.actors_with_bacon_number(self.data, n))
+        for actor in random.sample(sorted(tree), 10):
+            p = lab.bacon_path(index, actor)
+            self.assertEqual(len(p), tree[actor] + 1)
+            self.assertTrue(valid_path(self.data, p))
+        self.assertIsNone(lab.bacon_path(index, 1))
+        self.assertIsNone(lab.bacon_path(index, 4724))
+        self.assertEqual(lab.bacon_path(index, 4724), lab.bacon_path(self.data, 4724))
+
+    def test_update(self):
+        index = lab.BaconIndex(self.data)
+        a, b = index.layer(1)[0], index.layer(2)[0]
+        data = self.data + [(a, b, 1)]
+        self.assertFalse(index.update(data))
+        data.append((4724, index.layer(3)[0], 1))
+        self.assertTrue(index.update(data))
+        self.assertEqual(index.layers, lab.BaconIndex(data).layers)
+
+    def test_saved(self):
+        index = lab.load_bacon_index(self.data, self.filename)
+        loaded = lab.BaconIndex.load(self.filename)
+        self.assertEqual(loaded.layers, index.layers)
+        self.assertEqual(loaded.parents, index.parents)
+        data = self.data + [(4724, 1, 1)]
+        self.assertEqual(lab.load_bacon_index(data, self.filename).layer(1), lab.BaconIndex(data).layer(1))
+        self.assertEqual(lab.BaconIndex.load(self.filename).triples, len(data))
+
+    def test_saved_for_other_database(self):
+        a = [(4724, 1, 0), (1, 9, 0)]
+        b = [(4724, 9, 0), (9, 1, 0)]
+        lab.load_bacon_index(a, self.filename)
+        self.assertEqual(lab.actors_with_bacon_number(lab.load_bacon_index(b, self.filename), 1), {9})
+        lab.load_bacon_index(a, self.filename)
+        longer = b + [(1, 2, 0)]
+        self.assertEqual(lab.actors_with_bacon_number(lab.load_bacon_index(longer, self.filename), 1), {9})
+        index = lab.BaconIndex(a)
+        self.assertTrue(index.update(longer))
+        self.assertEqual(index.layer(1), [9])
+
+
 def random_number_list(L, i=1):
     o = list(range(i*100000, i*100000+L))
     random.shuffle(o)